@@ -0,0 +1,76 @@
+# Measures startup cost of the game's images and sounds, comparing loading
+# everything in assets/manifest.json up front (the old preload) with loading
+# on first use, then the memory held as the player moves between planets.
+#
+# Usage: python bench_assets.py
+
+import os
+import resource
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+PLANETS = ['OBERON', 'REPTILIA']
+
+
+def start():
+    import pygame
+    pygame.display.init()
+    pygame.mixer.init()
+    pygame.display.set_mode((1, 1))
+
+    from game import assets
+    return assets
+
+
+def run_eager():
+    assets = start()
+    begin = time.perf_counter()
+    assets.load_manifest()
+    for name in list(assets._image_paths):
+        assets.get_image(name)
+    for name in list(assets._sound_paths):
+        assets.get_sound(name)
+    report('eager', begin, assets)
+
+
+def run_lazy():
+    assets = start()
+    begin = time.perf_counter()
+    assets.load_manifest()
+    report('lazy', begin, assets)
+
+    held = ()
+    for planet in PLANETS:
+        names = assets.group(planet)
+        assets.acquire(names)
+        assets.release(held)
+        held = names
+        for name in names:
+            assets.get_image(name)
+        print('  in %-10s %s' % (planet, assets.stats()))
+
+
+def report(label, begin, assets):
+    elapsed = (time.perf_counter() - begin) * 1000.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-5s startup: %.2f ms, peak rss %d KB, %s' %
+          (label, elapsed, rss, assets.stats()))
+
+
+def main(argv):
+    if argv[:1] == ['eager']:
+        run_eager()
+    elif argv[:1] == ['lazy']:
+        run_lazy()
+    else:
+        # Each in a fresh process, so neither sees the other's loads
+        for mode in ('eager', 'lazy'):
+            subprocess.call([sys.executable, __file__, mode])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,147 @@
+# Measures per-frame collision cost on a stage, comparing the old linear
+# sweep over every entity in the room with the spatial hash behind collides_*.
+#
+# Usage: python bench_collision.py [stage.tmx ...] [-c CELL_SIZE]
+
+import random
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+
+import core
+from core import Entity, EntityRoom
+
+DEFAULT_STAGES = ['assets/stage/oberon_skeleton_cove.tmx',
+                  'assets/stage/reptilia_underpass.tmx']
+
+FRAMES = 200
+PROBES = 40  # moving entities performing collision checks each frame
+
+
+class Probe(Entity):
+
+    def __init__(self, x, y, velocity_x, velocity_y):
+        Entity.__init__(self, x, y)
+        self.width = 10
+        self.height = 12
+        self.velocity_x = velocity_x
+        self.velocity_y = velocity_y
+
+
+def linear_collides_solid(entity, x, y):
+    # The pre-hash implementation of Entity.collides_solid
+    collisions = []
+    for other in core.ENTITY_ROOM:
+        if other == entity or not other.active:
+            continue
+        elif other.solid and entity.collides(other, x, y):
+            collisions.append(other)
+    return collisions
+
+
+def hashed_collides_solid(entity, x, y):
+    return entity.collides_solid(x, y)
+
+
+def load_solids(path):
+    solids = []
+    root = ElementTree.parse(path).getroot()
+    map_width = int(root.get('width')) * int(root.get('tilewidth'))
+    map_height = int(root.get('height')) * int(root.get('tileheight'))
+
+    for group in root.findall('objectgroup'):
+        if group.get('name') != 'SOLIDS':
+            continue
+
+        for obj in group.findall('object'):
+            x = float(obj.get('x'))
+            y = float(obj.get('y'))
+            w = float(obj.get('width', 0))
+            h = float(obj.get('height', 0))
+
+            polygon = obj.find('polygon')
+            if polygon is not None:
+                for point in polygon.get('points').split():
+                    px, py = [float(v) for v in point.split(',')]
+                    w = max(w, abs(px))
+                    if py != 0:
+                        h = abs(py)
+                        if py < 0:
+                            y -= h
+
+            solid = Entity(x, y)
+            solid.width = w
+            solid.height = h
+            solid.solid = True
+            solids.append(solid)
+
+    return solids, map_width, map_height
+
+
+def simulate_frame(probes, collides_solid, map_width, map_height):
+    # Mirrors the checks collision_resolution and solid_below/above/left/right
+    # make for every moving entity in a frame
+    for probe in probes:
+        temp_x = probe.x + probe.velocity_x
+        temp_y = probe.y + probe.velocity_y
+
+        collides_solid(probe, temp_x, temp_y)
+        collides_solid(probe, temp_x, temp_y + 1)
+        collides_solid(probe, temp_x - 1, temp_y)
+        collides_solid(probe, temp_x + 1, temp_y)
+
+        if not 0 <= temp_x < map_width - probe.width:
+            probe.velocity_x *= -1
+            temp_x = probe.x
+        if not 0 <= temp_y < map_height - probe.height:
+            probe.velocity_y *= -1
+            temp_y = probe.y
+
+        probe.x = temp_x
+        probe.y = temp_y
+
+
+def run(path, collides_solid, cell_size):
+    room = EntityRoom(cell_size)
+    core.ENTITY_ROOM = room
+
+    solids, map_width, map_height = load_solids(path)
+    for solid in solids:
+        room.add(solid)
+
+    rng = random.Random(0)
+    probes = []
+    for _ in xrange(PROBES):
+        probe = Probe(rng.uniform(0, map_width - 10),
+                      rng.uniform(0, map_height - 12),
+                      rng.uniform(-2.5, 2.5), rng.uniform(-2.5, 2.5))
+        probes.append(room.add(probe))
+
+    start = time.time()
+    for _ in xrange(FRAMES):
+        simulate_frame(probes, collides_solid, map_width, map_height)
+    elapsed = time.time() - start
+
+    core.ENTITY_ROOM = None
+    return len(solids), elapsed / FRAMES * 1000.0
+
+
+def main(argv):
+    cell_size = 32
+    if '-c' in argv:
+        i = argv.index('-c')
+        cell_size = int(argv[i + 1])
+        del argv[i:i + 2]
+
+    stages = argv or DEFAULT_STAGES
+    for path in stages:
+        solid_count, linear_ms = run(path, linear_collides_solid, cell_size)
+        _, hashed_ms = run(path, hashed_collides_solid, cell_size)
+
+        print '%s (%d solids, %d probes)' % (path, solid_count, PROBES)
+        print '  linear: %.3f ms/frame' % linear_ms
+        print '  hashed: %.3f ms/frame (cell size %d)' % (hashed_ms, cell_size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
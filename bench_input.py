@@ -0,0 +1,157 @@
+# Measures per-frame keyboard query cost, comparing the old get_key_code
+# if/elif chain and key state snapshots with the KEY_CODES dict and the
+# event driven key sets, and the old Python scan for pressed('ANY') with the
+# current check.
+#
+# Usage: python bench_input.py [-n FRAMES]
+
+import os
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+
+import core
+from core import Input
+
+# Player.update polls these every frame
+KEYS = {
+    'UP': 'up',
+    'DOWN': 'down',
+    'LEFT': 'left',
+    'RIGHT': 'right',
+    'ATTACK': 'x',
+    'CHANGE_WEAPON': 'c',
+    'JUMP': 'space',
+    'INTERACT': 'up',
+    'DASH': 'lshift',
+    'PAUSE': 'p'
+}
+
+# Key names in the order the old get_key_code tested them
+LEGACY_ORDER = ['enter', 'escape', 'lshift', 'space',
+                'left', 'right', 'up', 'down'] + \
+               [str(digit) for digit in range(1, 10)] + ['0'] + \
+               ['F' + str(number) for number in range(1, 13)] + \
+               [chr(letter) for letter in range(ord('a'), ord('z') + 1)]
+
+
+def build_legacy_get_key_code():
+    # Rebuilds the old if/elif chain so each lookup costs what it used to
+    lines = ['def legacy_get_key_code(key):']
+    for i, name in enumerate(LEGACY_ORDER):
+        lines.append('    %s key == %r:' % ('if' if i == 0 else 'elif', name))
+        lines.append('        return %d' % Input.KEY_CODES[name])
+    lines.append('    else:')
+    lines.append('        return -1')
+
+    namespace = {}
+    exec '\n'.join(lines) in namespace
+    return namespace['legacy_get_key_code']
+
+
+legacy_get_key_code = build_legacy_get_key_code()
+
+
+# The old Input kept pygame.key.get_pressed() snapshots from this frame and
+# the last one
+legacy_key_state = {'prev': (), 'curr': ()}
+
+
+def legacy_poll_keyboard():
+    legacy_key_state['prev'] = legacy_key_state['curr']
+    legacy_key_state['curr'] = pygame.key.get_pressed()
+
+
+def legacy_down(key):
+    code = legacy_get_key_code(key)
+    if code != -1:
+        return legacy_key_state['curr'][code]
+    return False
+
+
+def legacy_pressed_any():
+    curr = legacy_key_state['curr']
+    prev = legacy_key_state['prev']
+    for code in range(len(curr)):
+        if curr[code] and not prev[code]:
+            return True
+    return False
+
+
+def set_key_state(previous, current):
+    legacy_key_state['prev'] = previous
+    legacy_key_state['curr'] = current
+
+    # The same frame as the event driven input sees it
+    Input.down_keys = set(code for code, down in enumerate(current) if down)
+    Input.pressed_keys = set(code for code in Input.down_keys
+                             if not previous[code])
+    Input.released_keys = set(code for code, down in enumerate(previous)
+                              if down and not current[code])
+
+
+def time_frames(frames, poll):
+    start = time.time()
+    for _ in xrange(frames):
+        poll()
+    return (time.time() - start) / frames * 1000000.0
+
+
+def main(argv):
+    frames = 20000
+    if '-n' in argv:
+        frames = int(argv[argv.index('-n') + 1])
+
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+
+    idle = pygame.key.get_pressed()
+    pressed = list(idle)
+    pressed[core.K_p] = 1
+    pressed = tuple(pressed)
+
+    names = KEYS.values()
+    codes = Input.bind(KEYS).values()
+
+    set_key_state(idle, idle)
+
+    def legacy_keys():
+        for key in names:
+            legacy_down(key)
+
+    def named_keys():
+        for key in names:
+            Input.down(key)
+
+    def bound_keys():
+        for code in codes:
+            Input.down(code)
+
+    print '%d key queries per frame, %d frames' % (len(names), frames)
+    print '  if/elif chain: %.2f us/frame' % time_frames(frames, legacy_keys)
+    print '  dict lookup:   %.2f us/frame' % time_frames(frames, named_keys)
+    print '  bound codes:   %.2f us/frame' % time_frames(frames, bound_keys)
+
+    def current_any():
+        Input.pressed('ANY')
+
+    print "pressed('ANY')"
+    for label, previous, current in (('no change', idle, idle),
+                                     ('key pressed', idle, pressed),
+                                     ('key released', pressed, idle)):
+        set_key_state(previous, current)
+        print '  %-12s old: %.2f us, new: %.2f us' % (
+            label, time_frames(frames, legacy_pressed_any),
+            time_frames(frames, current_any))
+
+    print 'poll'
+    print '  get_pressed snapshot: %.2f us' % time_frames(
+        frames, legacy_poll_keyboard)
+    print '  event edge buffers:   %.2f us' % time_frames(frames, Input.poll)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
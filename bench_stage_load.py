@@ -0,0 +1,55 @@
+# Measures stage load time for every stage in assets/stage, comparing
+# peachy's TMX parser with the compiled stage format (see compile_stages.py).
+#
+# Usage: python bench_stage_load.py [-n REPEATS]
+
+import glob
+import os
+import sys
+import time
+
+import pygame
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+pygame.display.init()
+pygame.display.set_mode((1, 1))
+
+import peachy
+from game import stage
+
+STAGE_DIRECTORY = 'assets/stage'
+
+
+def time_load(load, path, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        stage_data = load(path)
+        stage_data.clear()
+    return (time.perf_counter() - start) / repeats * 1000.0
+
+
+def main(argv):
+    repeats = 5
+    if '-n' in argv:
+        repeats = int(argv[argv.index('-n') + 1])
+
+    total_tmx = 0
+    total_compiled = 0
+
+    print('%-40s %10s %10s' % ('stage', 'tmx ms', 'compiled'))
+    for path in sorted(glob.glob(os.path.join(STAGE_DIRECTORY, '*.tmx'))):
+        if stage.load_compiled(path) is None:
+            stage.compile_stage(path)
+
+        tmx_ms = time_load(peachy.stage.load_tiled_tmx, path, repeats)
+        compiled_ms = time_load(stage.load_compiled, path, repeats)
+        total_tmx += tmx_ms
+        total_compiled += compiled_ms
+
+        print('%-40s %10.2f %10.2f' % (os.path.basename(path), tmx_ms,
+                                       compiled_ms))
+    print('%-40s %10.2f %10.2f' % ('total', total_tmx, total_compiled))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,34 @@
+# Compiles Tiled stages into the binary format read by game.stage.load_stage.
+# Stages whose compiled file is already up to date are skipped.
+#
+# Usage: python compile_stages.py [stage.tmx ...]
+
+import glob
+import os
+import sys
+
+from game import stage
+
+STAGE_DIRECTORY = 'assets/stage'
+
+
+def main(paths):
+    if not paths:
+        paths = glob.glob(os.path.join(STAGE_DIRECTORY, '*.tmx')) + \
+            glob.glob(os.path.join(STAGE_DIRECTORY, 'test', '*.tmx'))
+
+    for path in sorted(paths):
+        compiled = stage.load_compiled(path)
+        if compiled is not None:
+            compiled.clear()
+            continue
+
+        try:
+            output = stage.compile_stage(path)
+            print('compiled ' + path + ' -> ' + output)
+        except Exception as error:
+            print('[ERROR] could not compile ' + path + ': ' + str(error))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,7 +2,15 @@ import os
 import platform
 import pygame
 import sys
+import weakref
+from collections import OrderedDict
 from pygame.locals import *
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ENTITY_ROOM = None
 
@@ -14,14 +22,43 @@ class GC(object):
     _scale = -1
     _title = ''
 
+    # Upscaling, see _set_upscaler. peachy.Engine scales the game's own
+    # window; these backends only apply to GC.run
+    _upscale = None
+    _scaled_surface = None
+    _scaled_offset = (0, 0)
+    _integer_scale = 1
+
+    # 'scaled':    SDL scales the display itself (pygame.SCALED, pygame 2)
+    # 'integer':   nearest neighbour by the largest whole factor that fits the
+    #              window, into a cached surface centered on the window
+    # 'numpy':     the same, by repeating pixel rows and columns with NumPy
+    # 'transform': stretch to fill the window
+    UPSCALERS = ('scaled', 'integer', 'numpy', 'transform')
+    upscaler = None
+
     view_size = (0, 0)
     window_size = (0, 0)
     world = None
 
+    # Simulation runs at a fixed TICK_RATE, independent of how often frames
+    # are rendered. A slow frame is caught up with at most MAX_CATCH_UP ticks.
+    # (GC.run only; the game itself is driven by peachy.Engine's loop.)
+    TICK_RATE = 45
+    MAX_CATCH_UP = 5
+    max_fps = TICK_RATE     # Render cap, 0 renders as fast as possible
+
+    # Milliseconds spent on the last frame, its events and input polls, its
+    # updates, the world's render, upscaling and display.flip, and the number
+    # of ticks it ran
+    timings = {'tick': 0.0, 'input': 0.0, 'update': 0.0, 'render': 0.0,
+               'upscale': 0.0, 'flip': 0.0, 'updates': 0}
+
     DEBUG = False
 
     @staticmethod
-    def init(view_size, scale=1, title='Game', debug=False):
+    def init(view_size, scale=1, title='Game', debug=False,
+             tick_rate=45, max_fps=None, upscaler=None):
 
         os.environ['SDL_VIDEO_CENTERED'] = "1"
 
@@ -52,70 +89,114 @@ class GC(object):
         GC._title = title
         GC._scale = scale
 
+        GC.TICK_RATE = tick_rate
+        GC.max_fps = tick_rate if max_fps is None else max_fps
+
         # Init joysticks
-        # TODO Fix joystick functionality
         joystick_count = pygame.joystick.get_count()
         for i in range(joystick_count):
             Input.joystick_raw.append(pygame.joystick.Joystick(i))
             Input.joystick_raw[i].init()
             Input.joystick.append({
-                'AXIS': [], 
-                'BUTTON': [] 
+                'AXIS': [0.0] * Input.joystick_raw[i].get_numaxes(),
+                'BUTTON': [0] * Input.joystick_raw[i].get_numbuttons(),
+                'HAT': [(0, 0)] * Input.joystick_raw[i].get_numhats()
             })
+            if hasattr(Input.joystick_raw[i], 'get_instance_id'):
+                Input.joystick_ids[Input.joystick_raw[i].get_instance_id()] = i
 
         # Init display
         pygame.display.set_caption(title)
 
         GC.view_size = view_size
         GC.window_size = (view_size[0] * scale, view_size[1] * scale)
-        
-        GC._window_surface = pygame.display.set_mode(GC.window_size)
-        GC._render_surface = pygame.Surface(GC.view_size)
-        
-        Graphics._MAIN_CONTEXT = GC._render_surface
-        Graphics.set_context(GC._render_surface)
+
+        if upscaler is None:
+            upscaler = GC._fastest_upscaler()
+        GC._set_upscaler(upscaler)
 
         # Init debug
         if debug:
             GC.DEBUG = True
             print platform.system()
+            print 'Upscaler: ' + GC.upscaler
 
     @staticmethod
     def run():
         game_timer = pygame.time.Clock()
-        Input.poll_keyboard()
+        Input.poll()
+
+        tick_length = 1.0 / GC.TICK_RATE
+        max_accumulated = tick_length * GC.MAX_CATCH_UP
+
+        # Start a full tick in so the world updates before its first render
+        accumulator = tick_length
+        previous_time = default_timer()
 
         running = True
 
         try:
             while running:
 
+                frame_start = default_timer()
+                frame_time = frame_start - previous_time
+                previous_time = frame_start
+
+                # Time beyond the catch-up cap is dropped, slowing the game
+                # down rather than stalling it on updates
+                accumulator = min(accumulator + frame_time, max_accumulated)
+
                 # Parse events
                 for event in pygame.event.get():
                     if event.type == QUIT:
                         running = False
-
-                # Update
-                Input.poll_keyboard()
-                GC.world.update()
+                    else:
+                        Input.handle_event(event)
+                input_time = default_timer() - frame_start
+
+                # Update - fixed ticks
+                updates = 0
+                while accumulator >= tick_length:
+                    poll_start = default_timer()
+                    Input.poll()
+                    input_time += default_timer() - poll_start
+                    GC.world.update()
+                    accumulator -= tick_length
+                    updates += 1
+
+                update_end = default_timer()
 
                 # Render - Draw World
+                Graphics.flip_cache_hits = 0
                 GC._render_surface.fill((0, 0, 0))
                 GC.world.render()
+                render_end = default_timer()
 
                 # Render - Transformations
-                # TODO speed up scaling somehow
-                render_size = GC.window_size
-                pygame.transform.scale(GC._render_surface, render_size, GC._window_surface)
+                GC._upscale()
+                upscale_end = default_timer()
 
                 # Render - Finalize
                 pygame.display.flip()
-
-                # Maintain 45 fps
-                game_timer.tick(45)
+                flip_end = default_timer()
+
+                timings = GC.timings
+                timings['tick'] = frame_time * 1000.0
+                timings['input'] = input_time * 1000.0
+                timings['update'] = \
+                    (update_end - frame_start - input_time) * 1000.0
+                timings['render'] = (render_end - update_end) * 1000.0
+                timings['upscale'] = (upscale_end - render_end) * 1000.0
+                timings['flip'] = (flip_end - upscale_end) * 1000.0
+                timings['updates'] = updates
+
+                # Throttle rendering, the simulation rate is kept above
+                game_timer.tick(GC.max_fps)
                 if GC.DEBUG:
                     fps = round(game_timer.get_fps())
-                    pygame.display.set_caption(GC._title + ' {' + str(fps) + '}')
+                    pygame.display.set_caption(GC._title + ' {' + str(fps) + '}' +
+                                               ' flips cached: ' +
+                                               str(Graphics.flip_cache_hits))
             
             GC.world.exit()
             pygame.quit()
@@ -128,6 +209,10 @@ class GC(object):
 
     @staticmethod
     def toggle_fullscreen():
+        if GC.upscaler == 'scaled':
+            pygame.display.toggle_fullscreen()
+            return
+
         screen = pygame.display.get_surface()
         caption = pygame.display.get_caption()
         
@@ -151,16 +236,131 @@ class GC(object):
             GC.window_size = (GC.view_size[0] * GC._scale, GC.view_size[1] * GC._scale)
         pygame.display.set_caption(*caption)
 
-        GC._window_surface = pygame.display.set_mode(GC.window_size, flags^FULLSCREEN, bits)
-        GC._render_surface = pygame.Surface(GC.view_size)
+        GC._set_upscaler(GC.upscaler, flags^FULLSCREEN, bits)
+        AssetManager.reconvert_images()
+
+    @staticmethod
+    def quit():
+        pygame.event.post(pygame.event.Event(QUIT))
+
+    @staticmethod
+    def _available_upscalers():
+        upscalers = []
+        if hasattr(pygame, 'SCALED'):
+            upscalers.append('scaled')
+        upscalers.append('integer')
+        if numpy is not None:
+            upscalers.append('numpy')
+        return upscalers
+
+    @staticmethod
+    def _fastest_upscaler(frames=30):
+        # Hardware scaling costs nothing per frame, otherwise time each
+        # software path on the actual window
+        available = GC._available_upscalers()
+        if 'scaled' in available:
+            return 'scaled'
+
+        fastest = None
+        fastest_time = None
+        for upscaler in available:
+            try:
+                GC._set_upscaler(upscaler)
+                GC._upscale()
+                start = default_timer()
+                for _ in xrange(frames):
+                    GC._upscale()
+                elapsed = default_timer() - start
+            except Exception:
+                continue
+            if fastest is None or elapsed < fastest_time:
+                fastest = upscaler
+                fastest_time = elapsed
+        return fastest or 'transform'
 
+    @staticmethod
+    def _set_upscaler(upscaler, flags=0, bits=0):
+        # (Re)create the display for an upscaler, then everything cached
+        # against it
+        if upscaler not in GC.UPSCALERS:
+            raise ValueError('Unknown upscaler: ' + str(upscaler))
+
+        GC.upscaler = upscaler
+
+        if upscaler == 'scaled':
+            GC._window_surface = pygame.display.set_mode(
+                GC.view_size, flags | pygame.SCALED)
+            GC._render_surface = GC._window_surface
+            GC._upscale = staticmethod(GC._upscale_none)
+        else:
+            if pygame.display.get_surface() is None or \
+               pygame.display.get_surface().get_size() != GC.window_size:
+                GC._window_surface = pygame.display.set_mode(GC.window_size,
+                                                             flags, bits)
+            else:
+                GC._window_surface = pygame.display.get_surface()
+
+            # Matching the window's pixel format keeps scaling a straight copy
+            if GC._window_surface.get_bitsize() >= 16:
+                GC._render_surface = pygame.Surface(GC.view_size, 0,
+                                                    GC._window_surface)
+            else:
+                GC._render_surface = pygame.Surface(GC.view_size)
+
+            window_width, window_height = GC.window_size
+            scale = max(1, min(window_width // GC.view_size[0],
+                               window_height // GC.view_size[1]))
+            scaled_size = (GC.view_size[0] * scale, GC.view_size[1] * scale)
+
+            GC._integer_scale = scale
+            GC._scaled_offset = ((window_width - scaled_size[0]) // 2,
+                                 (window_height - scaled_size[1]) // 2)
+            if scaled_size == GC.window_size and \
+               GC._window_surface.get_bitsize() == \
+               GC._render_surface.get_bitsize():
+                GC._scaled_surface = GC._window_surface
+            else:
+                GC._scaled_surface = pygame.Surface(scaled_size, 0,
+                                                    GC._render_surface)
+
+            GC._upscale = staticmethod({
+                'integer': GC._upscale_integer,
+                'numpy': GC._upscale_numpy,
+                'transform': GC._upscale_transform
+            }[upscaler])
 
         Graphics._MAIN_CONTEXT = GC._render_surface
         Graphics.set_context(GC._render_surface)
 
     @staticmethod
-    def quit():
-        pygame.event.post(pygame.event.Event(QUIT))
+    def _present_scaled():
+        if GC._scaled_surface is not GC._window_surface:
+            GC._window_surface.blit(GC._scaled_surface, GC._scaled_offset)
+
+    @staticmethod
+    def _upscale_integer():
+        pygame.transform.scale(GC._render_surface,
+                               GC._scaled_surface.get_size(),
+                               GC._scaled_surface)
+        GC._present_scaled()
+
+    @staticmethod
+    def _upscale_none():
+        return
+
+    @staticmethod
+    def _upscale_numpy():
+        scale = GC._integer_scale
+        source = pygame.surfarray.pixels2d(GC._render_surface)
+        target = pygame.surfarray.pixels2d(GC._scaled_surface)
+        target[...] = source.repeat(scale, 0).repeat(scale, 1)
+        del source, target  # Unlock both surfaces before blitting
+        GC._present_scaled()
+
+    @staticmethod
+    def _upscale_transform():
+        pygame.transform.scale(GC._render_surface, GC.window_size,
+                               GC._window_surface)
 
 
 class AssetManager(object):
@@ -170,6 +370,13 @@ class AssetManager(object):
     stored_images = dict()
     stored_sounds = dict()
 
+    # Colorkey each image was loaded with, so it can be converted again when
+    # the display is recreated
+    image_colorkeys = dict()
+
+    # Stands in for clear pixels when an image's alpha is all or nothing
+    COLORKEY = (255, 0, 255)
+
     @staticmethod
     def get_font(asset_name):
         return AssetManager.stored_fonts.get(asset_name)
@@ -197,20 +404,79 @@ class AssetManager(object):
             print '[ERROR] could not load Font: ' + path
 
     @staticmethod
-    def load_image(asset_name, path):
-        """Retrieves an image from the HDD"""
+    def load_image(asset_name, path, colorkey=None):
+        """Retrieves an image from the HDD, converted to the display format.
+        colorkey marks a color as clear, as Tiled's trans attribute does"""
 
         path = path.lstrip('../')  # cannot rise outside of asset_path
 
         try:
             image = pygame.image.load(os.path.join(AssetManager.assets_path, path))
-            image.convert_alpha()
+            image = AssetManager.display_format(image, colorkey)
             AssetManager.stored_images[asset_name] = image
+            AssetManager.image_colorkeys[asset_name] = colorkey
             return image
         except IOError:
             print '[ERROR] could not find Image: ' + path
             GC.quit()
 
+    @staticmethod
+    def display_format(image, colorkey=None):
+        """Convert image to the display's pixel format, with convert() and a
+        colorkey unless its alpha is partial and needs convert_alpha()"""
+
+        if colorkey is not None:
+            image = image.convert()
+            image.set_colorkey(colorkey, RLEACCEL)
+            return image
+        elif not image.get_flags() & SRCALPHA:
+            return image.convert()  # keeps a colorkey set by the file
+
+        area = image.get_width() * image.get_height()
+        visible = pygame.mask.from_surface(image, 0).count()
+        opaque = pygame.mask.from_surface(image, 254).count()
+
+        if opaque == area:
+            image = image.convert()
+            image.set_alpha(None)  # convert() keeps the per-pixel alpha flag
+            return image
+        elif opaque == visible and numpy is not None:
+            keyed = AssetManager._colorkeyed(image)
+            if keyed is not None:
+                return keyed
+        return image.convert_alpha()
+
+    @staticmethod
+    def _colorkeyed(image):
+        # Clear pixels become COLORKEY, unless an opaque pixel already uses
+        # it. Pixels are copied, an alpha blit would round opaque colors.
+        keyed = image.convert()
+        keyed.set_alpha(None)
+        key = keyed.map_rgb(AssetManager.COLORKEY)
+        try:
+            clear = pygame.surfarray.array_alpha(image) == 0
+            pixels = pygame.surfarray.pixels2d(keyed)
+        except ValueError:
+            return None  # 24 bit displays have no 2d pixel view
+
+        if (pixels[~clear] == key).any():
+            return None
+        pixels[clear] = key
+        del pixels  # unlocks keyed
+
+        keyed.set_colorkey(AssetManager.COLORKEY, RLEACCEL)
+        return keyed
+
+    @staticmethod
+    def reconvert_images():
+        """Convert every stored image to the current display format. Needed
+        whenever the display is recreated"""
+
+        for asset_name, image in AssetManager.stored_images.items():
+            AssetManager.stored_images[asset_name] = \
+                AssetManager.display_format(
+                    image, AssetManager.image_colorkeys.get(asset_name))
+
     @staticmethod
     def load_sound(asset_name, path):
         """Retrieves a sound file from the HDD"""
@@ -237,20 +503,74 @@ class Entity(object):
 
         self.event_handle = None  # Used by events to access this entity, set on map load
 
-        self.x = x                # x coordinate
-        self.y = y                # y coordinate
-        self.width = 0            # width (collision detection)
-        self.height = 0           # height (collision detection)
+        self._x = x               # x coordinate
+        self._y = y               # y coordinate
+        self._width = 0           # width (collision detection)
+        self._height = 0          # height (collision detection)
 
         self.velocity_x = 0       # x-axis velocity
         self.velocity_y =  0      # y-axis velocity
         
-        self.active = True        # If the entity is being updated
+        self._active = True       # If the entity is being updated
         self.visible = True       # If the entity is being rendered
         self.solid = False        # If the entity registers as a solid object (collision detection)
 
         self.sprite = None        # sprite used for rendering
 
+    # Bounds are properties so the room's spatial hash follows every move
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = value
+        if ENTITY_ROOM is not None:
+            ENTITY_ROOM.moved(self)
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = value
+        if ENTITY_ROOM is not None:
+            ENTITY_ROOM.moved(self)
+
+    @property
+    def width(self):
+        return self._width
+
+    @width.setter
+    def width(self, value):
+        self._width = value
+        if ENTITY_ROOM is not None:
+            ENTITY_ROOM.moved(self)
+
+    @property
+    def height(self):
+        return self._height
+
+    @height.setter
+    def height(self, value):
+        self._height = value
+        if ENTITY_ROOM is not None:
+            ENTITY_ROOM.moved(self)
+
+    # The room keeps active and dormant entities apart, so it is told when
+    # this changes
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, value):
+        if value != self._active:
+            self._active = value
+            if ENTITY_ROOM is not None:
+                ENTITY_ROOM.activity_changed(self)
+
     def destroy(self):
         global ENTITY_ROOM
         self.active = False
@@ -291,8 +611,8 @@ class Entity(object):
         global ENTITY_ROOM
 
         collisions = []
-        for entity in ENTITY_ROOM.entities:
-            if entity == self or not entity.active:
+        for entity in ENTITY_ROOM.query_active(x, y, self.width, self.height):
+            if entity == self:
                 continue
             elif entity.group == group and self.collides(entity, x, y):
                 collisions.append(entity)
@@ -305,8 +625,8 @@ class Entity(object):
         global ENTITY_ROOM
 
         collisions = []
-        for entity in ENTITY_ROOM.entities:
-            if entity == self or not entity.active:
+        for entity in ENTITY_ROOM.query_active(x, y, self.width, self.height):
+            if entity == self:
                 continue
             elif entity.group in groups and self.collides(entity, x, y):
                 collisions.append(entity)
@@ -317,7 +637,7 @@ class Entity(object):
 
         global ENTITY_ROOM
 
-        for entity in ENTITY_ROOM.entities:
+        for entity in ENTITY_ROOM.query(x, y, self.width, self.height):
             if entity.name == name and self.collides(entity, x, y):
                 return entity
         return None
@@ -358,8 +678,8 @@ class Entity(object):
         global ENTITY_ROOM
         
         collisions = []
-        for entity in ENTITY_ROOM.entities:
-            if entity == self or not entity.active:
+        for entity in ENTITY_ROOM.query_active(x, y, self.width, self.height):
+            if entity == self:
                 continue
             elif entity.solid and self.collides(entity, x, y):
                 collisions.append(entity)
@@ -383,6 +703,7 @@ class Graphics(object):
     context_rect = None
 
     color = pygame.Color(0, 0, 0)
+    _color_key = (0, 0, 0, 255)  # color as a tuple, for the text cache
     font = None
 
     FLIP_X = 0x01
@@ -390,6 +711,20 @@ class Graphics(object):
 
     translate_x = 0
     translate_y = 0
+
+    # Flipped copies of images by source image, then flip flags. Entries are
+    # dropped along with their source surface. Images drawn flipped are
+    # expected not to be modified afterwards.
+    _flip_cache = weakref.WeakKeyDictionary()
+    flip_cache_hits = 0  # Reset every frame by GC.run
+
+    # Rendered strings by (font, colour, antialiasing, text). The cache is a
+    # two generation LRU: once the current generation holds TEXT_CACHE_SIZE
+    # strings it replaces the previous one, dropping whatever was not drawn
+    # since the last turnover.
+    TEXT_CACHE_SIZE = 256
+    _text_cache = {}
+    _text_cache_previous = {}
    
     @staticmethod
     def draw_image(image, x, y, args=0):
@@ -399,12 +734,28 @@ class Graphics(object):
         bounds = image.get_rect().move(x, y)
 
         if bounds.colliderect(Graphics.context_rect):
-            if args & Graphics.FLIP_X:
-                image = pygame.transform.flip(image, True, False)
-            if args & Graphics.FLIP_Y:
-                image = pygame.transform.flip(image, False, True)
+            if args & (Graphics.FLIP_X | Graphics.FLIP_Y):
+                image = Graphics.flip(image, args)
 
             Graphics.context.blit(image, (x, y))
+
+    @staticmethod
+    def flip(image, args):
+        flags = args & (Graphics.FLIP_X | Graphics.FLIP_Y)
+
+        flipped_images = Graphics._flip_cache.get(image)
+        if flipped_images is None:
+            flipped_images = Graphics._flip_cache[image] = {}
+
+        flipped = flipped_images.get(flags)
+        if flipped is None:
+            flipped = pygame.transform.flip(image,
+                                            bool(flags & Graphics.FLIP_X),
+                                            bool(flags & Graphics.FLIP_Y))
+            flipped_images[flags] = flipped
+        else:
+            Graphics.flip_cache_hits += 1
+        return flipped
     
     @staticmethod
     def draw_line(x1, y1, x2, y2):
@@ -434,15 +785,34 @@ class Graphics(object):
 
     @staticmethod   
     def draw_text(text, x, y, aa=False, center=False):
-        text_surface = Graphics.font.render(text, aa, Graphics.color)
-        text_rect = text_surface.get_rect()
-        text_rect.x = x - Graphics.translate_x
-        text_rect.y = y - Graphics.translate_y
+        x -= Graphics.translate_x
+        y -= Graphics.translate_y
 
+        text_surface = Graphics.render_text(text, aa)
         if center:
-            text_rect.centerx = Graphics.context.get_rect().centerx
+            x = Graphics.context_rect.centerx - text_surface.get_width() / 2
 
-        Graphics.context.blit(text_surface, text_rect)
+        Graphics.context.blit(text_surface, (x, y))
+
+    @staticmethod
+    def render_text(text, aa=False, font=None):
+        if font is None:
+            font = Graphics.font
+
+        key = (font, Graphics._color_key, aa, text)
+        text_surface = Graphics._text_cache.get(key)
+        if text_surface is not None:
+            return text_surface
+
+        text_surface = Graphics._text_cache_previous.get(key)
+        if text_surface is None:
+            text_surface = font.render(text, aa, Graphics.color)
+
+        if len(Graphics._text_cache) >= Graphics.TEXT_CACHE_SIZE:
+            Graphics._text_cache_previous = Graphics._text_cache
+            Graphics._text_cache = {}
+        Graphics._text_cache[key] = text_surface
+        return text_surface
 
     @staticmethod
     def rotate(image, degree):
@@ -453,6 +823,7 @@ class Graphics(object):
         if (0 <= r <= 255) and (0 <= g <= 255) and (0 <= b <= 255) and (0 <= a <= 255):
             # TODO fix alpha
             Graphics.color = pygame.Color(r, g, b, a)
+            Graphics._color_key = (r, g, b, a)
 
     @staticmethod
     def set_context(context):
@@ -504,232 +875,215 @@ class Sound(object):
         self.sound_file.stop()
 
 
-class Input(object):
+def _key_codes():
+    codes = {
+        'enter': K_RETURN,
+        'escape': K_ESCAPE,
+        'lshift': K_LSHIFT,
+        'space': K_SPACE,
+        'left': K_LEFT,
+        'right': K_RIGHT,
+        'up': K_UP,
+        'down': K_DOWN
+    }
+    for digit in xrange(10):
+        codes[str(digit)] = K_0 + digit
+    for number in xrange(1, 13):
+        codes['F' + str(number)] = K_F1 + number - 1
+    for letter in xrange(ord('a'), ord('z') + 1):
+        codes[chr(letter)] = K_a + letter - ord('a')
+    return codes
 
-    curr_key_state = []
-    prev_key_state = []
 
+class Input(object):
+
+    # Key name -> pygame key code. Keys may also be given as codes directly,
+    # see bind()
+    KEY_CODES = _key_codes()
+
+    # Keys held down, and the press/release edges seen since the previous
+    # poll. Edges come from events, so presses shorter than a frame still
+    # register for one tick.
+    down_keys = set()
+    pressed_keys = set()
+    released_keys = set()
+    _pending_pressed = set()
+    _pending_released = set()
+
+    # Per joystick: {'AXIS': [value], 'BUTTON': [0 or 1], 'HAT': [(x, y)]},
+    # sized at GC.init and updated in place from events
     joystick = []
     joystick_raw = []
+    joystick_ids = {}  # instance id -> index above, pygame 2 only
+
+    # JOY_ names are read from any joystick. Buttons resolve to their index
+    # and directions, from the first two axes or a hat, to (axis, sign).
+    # Edges hold these codes.
+    JOY_DEADZONE = 0.5
+    JOY_CODES = {
+        'JOY_UP': (1, -1),
+        'JOY_DOWN': (1, 1),
+        'JOY_LEFT': (0, -1),
+        'JOY_RIGHT': (0, 1)
+    }
+    joystick_pressed = set()
+    joystick_released = set()
+    _pending_joystick_pressed = set()
+    _pending_joystick_released = set()
     
     @staticmethod
     def down(key):
         code = Input.get_key_code(key)
-        if code != -1:
-            return Input.curr_key_state[code]
-        return False
+        if code == -1 and key[:4] == 'JOY_':
+            return Input.joystick_down(Input.get_joy_code(key))
+        return code in Input.down_keys
 
     @staticmethod
     def pressed(key):
-        if key == 'ANY':
-            for code in range(len(Input.curr_key_state)):
-                if Input.curr_key_state[code] and not Input.prev_key_state[code]:
-                    return True
-            return False
-        elif key[:3] == 'JOY':
-            return False
-            # TODO add functionality for custom axes
-
-            if len(Input.joystick) > 0:
-                joystick = Input.joystick[0]
-
-            code = key[4:]
-            if code == 'UP':
-                return False
-            elif code == 'DOWN':
-                return False
-            elif code == 'LEFT':
-                return False
-            elif code == 'RIGHT':
-                return False
-            elif key[4:10] == 'BUTTON':
-                result = False
-                try:
-                    code = int(key[10:])
-                    result = joystick['BUTTON'][code] == 0
-                except ValueError:
-                    if GC.DEBUG:
-                        print 'Cannot recognize JOY_BUTTON: {}'.format(key[10:])
-                except IndexError:
-                    if GC.DEBUG:
-                        print 'Invalid JOY_BUTTON index: {}'.format(code)
-                return result
-
+        if isinstance(key, int):
+            return key in Input.pressed_keys
+        elif key == 'ANY':
+            return bool(Input.pressed_keys or Input.joystick_pressed)
+        elif key[:4] == 'JOY_':
+            return Input.get_joy_code(key) in Input.joystick_pressed
         else:
-            code = Input.get_key_code(key)
-            if code != -1:
-                return Input.curr_key_state[code] and not Input.prev_key_state[code]
-            return False
+            return Input.get_key_code(key) in Input.pressed_keys
     
     @staticmethod
     def released(key):
-        code = Input.get_key_code(key)
-        if code != -1:
-            return not Input.curr_key_state[code] and Input.prev_key_state[code]
-        return False
+        if not isinstance(key, int) and key[:4] == 'JOY_':
+            return Input.get_joy_code(key) in Input.joystick_released
+        return Input.get_key_code(key) in Input.released_keys
 
     @staticmethod
-    def poll_joysticks():
-        # TODO Must supress all output due to an annoying bug in pygame where 
-        # SDL will print SDL_GET_BUTTON_XXX, everytime this method is called.
-        return
+    def joystick_down(code):
+        if code is None:
+            return False
+        elif isinstance(code, tuple):
+            axis, sign = code
+            for joystick in Input.joystick:
+                axes = joystick['AXIS']
+                if axis < len(axes) and \
+                   Input._axis_direction(axes[axis]) == sign:
+                    return True
+                for hat in joystick['HAT']:
+                    if Input._hat_direction(hat, axis) == sign:
+                        return True
+        else:
+            for joystick in Input.joystick:
+                buttons = joystick['BUTTON']
+                if code < len(buttons) and buttons[code]:
+                    return True
+        return False
 
-        old_out = sys.stdout
-        old_err = sys.stderr
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
-        for joy_i in range(len(Input.joystick_raw)):
-
-            joy_raw = Input.joystick_raw[joy_i]
-            joystick = Input.joystick[joy_i]
-
-            axes = []
-            axis_count = joy_raw.get_numaxes()
-            for axis_i in range(axis_count):
-                axis = joy_raw.get_axis(axis_i)
-                axes.append(axis)
-            joystick['AXIS'] = axes
-
-            buttons = []
-            button_count = joy_raw.get_numbuttons()
-            for button_i in range(button_count):
-                button = joy_raw.get_button(button_i)
-                buttons.append(button)
-            joystick['BUTTON'] = button
-
-        sys.stdout.close()
-        sys.stderr.close()
-        sys.stdout = old_out
-        sys.stderr = old_err
-    
     @staticmethod
-    def poll_keyboard():
-        Input.prev_key_state = Input.curr_key_state
-        Input.curr_key_state = pygame.key.get_pressed()
+    def handle_event(event):
+        if event.type == KEYDOWN:
+            Input.down_keys.add(event.key)
+            Input._pending_pressed.add(event.key)
+        elif event.type == KEYUP:
+            Input.down_keys.discard(event.key)
+            Input._pending_released.add(event.key)
+        elif event.type in (JOYAXISMOTION, JOYHATMOTION, JOYBUTTONDOWN,
+                            JOYBUTTONUP):
+            Input._handle_joystick_event(event)
 
-        if len(Input.joystick_raw) > 0:
-            Input.poll_joysticks()
-    
     @staticmethod
-    def get_key_code(key):
-        if key == 'enter':
-            return K_RETURN
-        elif key == 'escape':
-            return K_ESCAPE
-        elif key == 'lshift':
-            return K_LSHIFT
-        elif key == 'space':
-            return K_SPACE
-        elif key == 'left':
-            return K_LEFT
-        elif key == 'right':
-            return K_RIGHT
-        elif key == 'up':
-            return K_UP
-        elif key == 'down':
-            return K_DOWN
-
-        elif key == '1':
-            return K_1;
-        elif key == '2':
-            return K_2;
-        elif key == '3':
-            return K_3;
-        elif key == '4':
-            return K_4;
-        elif key == '5':
-            return K_5;
-        elif key == '6':
-            return K_6;
-        elif key == '7':
-            return K_7;
-        elif key == '8':
-            return K_8;
-        elif key == '9':
-            return K_9;
-        elif key == '0':
-            return K_0;
-
-        elif key == 'F1':
-            return K_F1;
-        elif key == 'F2':
-            return K_F2;
-        elif key == 'F3':
-            return K_F3;
-        elif key == 'F4':
-            return K_F4;
-        elif key == 'F5':
-            return K_F5;
-        elif key == 'F6':
-            return K_F6;
-        elif key == 'F7':
-            return K_F7;
-        elif key == 'F8':
-            return K_F8;
-        elif key == 'F9':
-            return K_F9;
-        elif key == 'F10':
-            return K_F10;
-        elif key == 'F11':
-            return K_F11;
-        elif key == 'F12':
-            return K_F12;
-
-        elif key == 'a':
-            return K_a
-        elif key == 'b':
-            return K_b
-        elif key == 'c':
-            return K_c
-        elif key == 'd':
-            return K_d
-        elif key == 'e':
-            return K_e
-        elif key == 'f':
-            return K_f
-        elif key == 'g':
-            return K_g
-        elif key == 'h':
-            return K_h
-        elif key == 'i':
-            return K_i
-        elif key == 'j':
-            return K_j
-        elif key == 'k':
-            return K_k
-        elif key == 'l':
-            return K_l
-        elif key == 'm':
-            return K_m
-        elif key == 'n':
-            return K_n
-        elif key == 'o':
-            return K_o
-        elif key == 'p':
-            return K_p
-        elif key == 'q':
-            return K_q
-        elif key == 'r':
-            return K_r
-        elif key == 's':
-            return K_s
-        elif key == 't':
-            return K_t
-        elif key == 'u':
-            return K_u
-        elif key == 'v':
-            return K_v
-        elif key == 'w':
-            return K_w
-        elif key == 'x':
-            return K_x
-        elif key == 'y':
-            return K_y
-        elif key == 'z':
-            return K_z
+    def _handle_joystick_event(event):
+        # Joysticks plugged in after GC.init were never opened, so their
+        # events are ignored. pygame 2 names the device by instance id,
+        # pygame 1 by the index it was opened at.
+        if hasattr(event, 'instance_id'):
+            index = Input.joystick_ids.get(event.instance_id)
         else:
+            index = event.joy
+        if index is None or not 0 <= index < len(Input.joystick):
+            return
+        joystick = Input.joystick[index]
+
+        if event.type == JOYAXISMOTION:
+            axes = joystick['AXIS']
+            if event.axis < 2:
+                Input._joystick_direction(
+                    event.axis, Input._axis_direction(axes[event.axis]),
+                    Input._axis_direction(event.value))
+            axes[event.axis] = event.value
+        elif event.type == JOYHATMOTION:
+            hats = joystick['HAT']
+            for axis in (0, 1):
+                Input._joystick_direction(
+                    axis, Input._hat_direction(hats[event.hat], axis),
+                    Input._hat_direction(event.value, axis))
+            hats[event.hat] = event.value
+        elif event.type == JOYBUTTONDOWN:
+            joystick['BUTTON'][event.button] = 1
+            Input._pending_joystick_pressed.add(event.button)
+        elif event.type == JOYBUTTONUP:
+            joystick['BUTTON'][event.button] = 0
+            Input._pending_joystick_released.add(event.button)
+
+    @staticmethod
+    def poll():
+        # Hand the edges gathered since the last poll to this tick
+        Input.pressed_keys, Input._pending_pressed = \
+            Input._pending_pressed, Input.pressed_keys
+        Input.released_keys, Input._pending_released = \
+            Input._pending_released, Input.released_keys
+        Input._pending_pressed.clear()
+        Input._pending_released.clear()
+
+        Input.joystick_pressed, Input._pending_joystick_pressed = \
+            Input._pending_joystick_pressed, Input.joystick_pressed
+        Input.joystick_released, Input._pending_joystick_released = \
+            Input._pending_joystick_released, Input.joystick_released
+        Input._pending_joystick_pressed.clear()
+        Input._pending_joystick_released.clear()
+
+    @staticmethod
+    def _axis_direction(value):
+        if value <= -Input.JOY_DEADZONE:
             return -1
+        elif value >= Input.JOY_DEADZONE:
+            return 1
+        return 0
+
+    @staticmethod
+    def _hat_direction(hat, axis):
+        # Hats report up as positive y
+        return hat[0] if axis == 0 else -hat[1]
+
+    @staticmethod
+    def _joystick_direction(axis, previous, current):
+        if previous != current:
+            if previous:
+                Input._pending_joystick_released.add((axis, previous))
+            if current:
+                Input._pending_joystick_pressed.add((axis, current))
+
+    @staticmethod
+    def bind(bindings):
+        """Resolve a dict of action -> key name to action -> key code, so
+        lookups are skipped when polling the bound keys every frame"""
+        return dict((action, Input.get_key_code(key))
+                    for action, key in bindings.items())
+
+    @staticmethod
+    def get_key_code(key):
+        if isinstance(key, int):
+            return key
+        return Input.KEY_CODES.get(key, -1)
+
+    @staticmethod
+    def get_joy_code(key):
+        code = Input.JOY_CODES.get(key)
+        if code is None and key[4:10] == 'BUTTON':
+            try:
+                code = int(key[10:])
+                Input.JOY_CODES[key] = code
+            except ValueError:
+                if GC.DEBUG:
+                    print 'Cannot recognize JOY_BUTTON: {}'.format(key[10:])
+        return code
 
 
 class State(object):
@@ -782,50 +1136,288 @@ class World(object):
         return
 
 
+class SpatialHash(object):
+    """Uniform grid that buckets entities by every cell their bounds touch"""
+
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = dict()         # (cell_x, cell_y) -> set of entities
+        self.entity_cells = dict()  # entity -> (min_cx, min_cy, max_cx, max_cy)
+
+    def __contains__(self, entity):
+        return entity in self.entity_cells
+
+    def cell_range(self, x, y, width, height):
+        size = self.cell_size
+        return (int(x // size), int(y // size),
+                int((x + width) // size), int((y + height) // size))
+
+    def clear(self):
+        self.cells.clear()
+        self.entity_cells.clear()
+
+    def insert(self, entity):
+        cell_range = self.cell_range(entity.x, entity.y,
+                                     entity.width, entity.height)
+        self.entity_cells[entity] = cell_range
+
+        min_cx, min_cy, max_cx, max_cy = cell_range
+        for cx in xrange(min_cx, max_cx + 1):
+            for cy in xrange(min_cy, max_cy + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    cell = self.cells[(cx, cy)] = set()
+                cell.add(entity)
+
+    def remove(self, entity):
+        cell_range = self.entity_cells.pop(entity, None)
+        if cell_range is None:
+            return
+
+        min_cx, min_cy, max_cx, max_cy = cell_range
+        for cx in xrange(min_cx, max_cx + 1):
+            for cy in xrange(min_cy, max_cy + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is not None:
+                    cell.discard(entity)
+                    if not cell:
+                        del self.cells[(cx, cy)]
+
+    def update(self, entity):
+        cell_range = self.entity_cells.get(entity)
+        if cell_range is None:
+            return  # Not tracked by this grid
+
+        # Only re-bucket when the entity crosses a cell boundary
+        if cell_range != self.cell_range(entity.x, entity.y,
+                                         entity.width, entity.height):
+            self.remove(entity)
+            self.insert(entity)
+
+    def query(self, x, y, width, height):
+        """Every entity sharing a cell with the rect (may include misses)"""
+        found = set()
+        min_cx, min_cy, max_cx, max_cy = self.cell_range(x, y, width, height)
+        for cx in xrange(min_cx, max_cx + 1):
+            for cy in xrange(min_cy, max_cy + 1):
+                cell = self.cells.get((cx, cy))
+                if cell:
+                    found.update(cell)
+        return found
+
+
 class EntityRoom(object):
 
-    def __init__(self):
-        self.entities = []
+    # Keep the spatial hash cells between a tile and a few tiles wide
+    MIN_CELL_SIZE = 16
+    MAX_CELL_SIZE = 64
+
+    def __init__(self, cell_size=32):
+        cell_size = EntityRoom._clamp_cell_size(cell_size)
+
+        # Active entities are hashed apart from dormant ones, so collision
+        # queries never see the dormant
+        self.grid = SpatialHash(cell_size)
+        self.dormant_grid = SpatialHash(cell_size)
+        self._active = set()
+        self._active_list = None      # _active in insertion order, cached
+
+        self._store = OrderedDict()   # insertion ordered set of entities
+        self._names = dict()          # name -> insertion ordered set
+        self._groups = dict()         # group -> insertion ordered set
+
+        # Changes made while the room is being iterated are applied after
+        self._iterating = 0
+        self._pending_adds = OrderedDict()
+        self._pending_removals = set()
+
+        self._add_count = 0
+
+    def __contains__(self, entity):
+        if entity in self._store:
+            return entity not in self._pending_removals
+        return entity in self._pending_adds
+
+    def __iter__(self):
+        self._iterating += 1
+        try:
+            for entity in self._store:
+                if entity not in self._pending_removals:
+                    yield entity
+        finally:
+            self._iterating -= 1
+            if self._iterating == 0:
+                self._flush()
+
+    def __len__(self):
+        return (len(self._store) - len(self._pending_removals) +
+                len(self._pending_adds))
+
+    @property
+    def entities(self):
+        return [entity for entity in self._store
+                if entity not in self._pending_removals] + \
+            list(self._pending_adds)
+
+    @property
+    def active_entities(self):
+        """Active entities in the order they were added, for update loops.
+        A new list whenever activity changes, so it is safe to iterate while
+        entities are added, removed, woken or put to sleep"""
+        if self._active_list is None:
+            self._active_list = sorted(self._active,
+                                       key=lambda e: e._room_order)
+        return self._active_list
+
+    def activity_changed(self, entity):
+        if entity.active:
+            if entity in self.dormant_grid:
+                self.dormant_grid.remove(entity)
+                self.grid.insert(entity)
+                self._active.add(entity)
+                self._active_list = None
+        elif entity in self.grid:
+            self.grid.remove(entity)
+            self.dormant_grid.insert(entity)
+            self._active.discard(entity)
+            self._active_list = None
 
     def add(self, entity):
-        self.entities.append(entity)
+        if entity in self:
+            return entity
+
+        # Remember insertion order so hashed queries match list order
+        entity._room_order = self._add_count
+        self._add_count += 1
+
+        if self._iterating:
+            if entity in self._pending_removals:
+                self._pending_removals.discard(entity)
+            else:
+                self._pending_adds[entity] = None
+        else:
+            self._store[entity] = None
+
+        if entity.name:
+            named = self._names.get(entity.name)
+            if named is None:
+                named = self._names[entity.name] = OrderedDict()
+            named[entity] = None
+        group = self._groups.get(entity.group)
+        if group is None:
+            group = self._groups[entity.group] = OrderedDict()
+        group[entity] = None
+
+        if entity.active:
+            self.grid.insert(entity)
+            self._active.add(entity)
+            self._active_list = None
+        else:
+            self.dormant_grid.insert(entity)
         return entity
 
     def clear(self):
-        del self.entities[:]
+        self._store.clear()
+        self._names.clear()
+        self._groups.clear()
+        self._pending_adds.clear()
+        self._pending_removals.clear()
+        self.grid.clear()
+        self.dormant_grid.clear()
+        self._active.clear()
+        self._active_list = None
+
+    def moved(self, entity):
+        if entity._active:
+            self.grid.update(entity)
+        else:
+            self.dormant_grid.update(entity)
+
+    def query(self, x, y, width, height):
+        """Entities near the rect, in the order they were added"""
+        nearby = self.grid.query(x, y, width, height)
+        nearby.update(self.dormant_grid.query(x, y, width, height))
+        return sorted(nearby, key=lambda e: e._room_order)
+
+    def query_active(self, x, y, width, height):
+        """Active entities near the rect, in the order they were added"""
+        nearby = self.grid.query(x, y, width, height)
+        return sorted(nearby, key=lambda e: e._room_order)
+
+    def set_cell_size(self, cell_size):
+        cell_size = EntityRoom._clamp_cell_size(cell_size)
+
+        self.grid = SpatialHash(cell_size)
+        self.dormant_grid = SpatialHash(cell_size)
+        for entity in self.entities:
+            if entity.active:
+                self.grid.insert(entity)
+            else:
+                self.dormant_grid.insert(entity)
+
+    @staticmethod
+    def _clamp_cell_size(cell_size):
+        return max(EntityRoom.MIN_CELL_SIZE,
+                   min(EntityRoom.MAX_CELL_SIZE, cell_size))
 
     def get_group(self, group_name):
-        ents = []
-        for e in self.entities:
-            if e.group == group_name:
-                ents.append(e)
-        return ents
+        return list(self._groups.get(group_name, ()))
 
     def get_name(self, name):
-        for e in self.entities:
-            if e.name == name:
-                return e
+        # The first entity added under name, as a scan of the room finds
+        named = self._names.get(name)
+        if named:
+            return next(iter(named))
+        return None
 
     def remove(self, entity):
-        try:
-            if entity in self.entities:
-                self.entities.remove(entity)
-        except ValueError:
-            pass  # Do nothing
+        if entity not in self:
+            return  # Do nothing
+
+        if entity in self._pending_adds:
+            del self._pending_adds[entity]
+        elif self._iterating:
+            self._pending_removals.add(entity)
+        else:
+            del self._store[entity]
+
+        named = self._names.get(entity.name)
+        if named is not None:
+            named.pop(entity, None)
+            if not named:
+                del self._names[entity.name]
+        group = self._groups.get(entity.group)
+        if group is not None:
+            group.pop(entity, None)
+            if not group:
+                del self._groups[entity.group]
+
+        self.grid.remove(entity)
+        self.dormant_grid.remove(entity)
+        if entity in self._active:
+            self._active.discard(entity)
+            self._active_list = None
 
     def remove_group(self, group_name):
-        for entity in self.entities:
-            if entity.group == group_name:
-                self.entities.remove(entity)
+        for entity in self.get_group(group_name):
+            self.remove(entity)
 
     def remove_name(self, entity_name):
-        for entity in self.entities:
-            if entity.name == entity_name:
-                self.entities.remove(entity)
-                break
+        entity = self.get_name(entity_name)
+        if entity is not None:
+            self.remove(entity)
 
     def render(self):
         return
 
     def update(self):
         return
+
+    def _flush(self):
+        for entity in self._pending_removals:
+            del self._store[entity]
+        self._pending_removals.clear()
+
+        for entity in self._pending_adds:
+            self._store[entity] = None
+        self._pending_adds.clear()
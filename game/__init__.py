@@ -1,7 +1,7 @@
 import sys
 
 import peachy
-from game import config
+from game import assets, config
 from game.worlds import MainMenuWorld, GameWorld
 
 
@@ -14,39 +14,8 @@ class OverYonderEngine(peachy.Engine):
         peachy.fs.load_font('MAIN', 'assets/visitor1.ttf', 10)
         peachy.graphics.set_font(peachy.fs.get_font('MAIN'))
 
-        # TODO add to loading list file
-        IMAGES = {
-            'BREAKABLE_TILE': 'img/entity_breakable_tile.png',
-            'DASHER': 'img/entity_dasher.png',
-            'DOOR': 'img/entity_door.png',
-            'HUD_HEALTH_FULL': 'img/hud_health_full.png',
-            'HUD_HEALTH_EMPTY': 'img/hud_health_empty.png',
-            'MOVING_PLATFORM': 'img/entity_moving_platform.png',
-            'PLAYER': 'img/entity_player.png',
-            'SAVE_STATION': 'img/entity_save_station.png',
-            'SIGN_POST': 'img/entity_sign_post.png',
-            'SKELETON': 'img/entity_skeleton.png',
-            'SMALL_GOLEM': 'img/entity_golem.png',
-            'SWITCH': 'img/entity_switch.png',
-            'UPGRADES': 'img/item_upgrades.png',
-            'WEIGHT': 'img/entity_weight.png',
-            'BACKGROUND_OBERON_INNER': 'img/bg_oberon_inner.png',
-            'BACKGROUND_OBERON_OUTER': 'img/bg_oberon_outer_TEMP.png',
-            'BACKGROUND_REPTILIA_FAR': 'img/bg_reptilia_far.png',
-            'BACKGROUND_REPTILIA_FARTHER': 'img/bg_reptilia_farther.png',
-            'BACKGROUND_REPTILIA_FARTHEST': 'img/bg_reptilia_farthest.png',
-            'VFX_TRANSITIONS': 'img/vfx_overlays.png'
-        }
-
-        SOUNDS = {
-            'FOOTSTEP': 'snd/sfx_step.wav'
-        }
-
-        for IMAGE_NAME, IMAGE_PATH in IMAGES.items():
-            peachy.fs.load_image(IMAGE_NAME, 'assets/' + IMAGE_PATH)
-
-        for SOUND_NAME, SOUND_PATH in SOUNDS.items():
-            peachy.fs.load_sound(SOUND_NAME, 'assets/' + SOUND_PATH)
+        # Images and sounds load on first use, see game/assets.py
+        assets.load_manifest()
 
         # GUI.init()
         self.add_world(MainMenuWorld())
@@ -57,3 +26,14 @@ class OverYonderEngine(peachy.Engine):
             self.world.stage._load_stage(override_stage)
         except IndexError:
             pass
+
+    # Recreating the display changes its pixel format, so loaded images
+    # are converted again to keep their blits free of conversion
+
+    def resize(self, width, height):
+        super().resize(width, height)
+        assets.reconvert()
+
+    def toggle_fullscreen(self):
+        super().toggle_fullscreen()
+        assets.reconvert()
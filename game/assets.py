@@ -0,0 +1,279 @@
+''' Images and sounds named in assets/manifest.json, loaded the first time
+they are asked for. Rooms acquire the assets their stage needs (its planet's
+group and its tilesets) and release them on leaving; an acquired asset is
+unloaded once nothing holds it. Assets fetched without being acquired stay
+loaded.
+
+Images outside any group can be packed into atlas sheets with pack_atlas.py,
+and are then served as subsurfaces of their sheet. '''
+import json
+import os
+
+import pygame
+
+from game import config
+
+MANIFEST = config.ASSET_PATH + 'manifest.json'
+
+# Atlas index: {'sheets': [path], 'images': {name: {'sheet': index,
+# 'rect': [x, y, w, h], 'source': path, 'mtime': source mtime}}}
+ATLAS = config.ASSET_PATH + 'atlas.json'
+ATLAS_SHEET = 'img/atlas_%d.png'
+ATLAS_SHEET_SIZE = 256
+
+# Stands in for the clear pixels of images whose alpha is all or nothing
+COLORKEY = (255, 0, 255)
+
+_image_paths = {}  # name -> path
+_sound_paths = {}
+_groups = {}       # group -> (name, ...)
+_colorkeys = {}    # path -> color drawn clear, for tilesets with trans set
+_atlas_rects = {}  # name -> (sheet index, Rect)
+_atlas_paths = []  # sheet index -> path
+_atlas_sheets = {} # sheet index -> Surface, loaded
+
+_images = {}       # name -> Surface, loaded
+_sounds = {}       # name -> Sound, loaded
+_references = {}   # name -> count
+
+
+def load_manifest(path=MANIFEST):
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    for name, asset_path in manifest.get('images', {}).items():
+        _image_paths[name] = config.ASSET_PATH + asset_path
+    for name, asset_path in manifest.get('sounds', {}).items():
+        _sound_paths[name] = config.ASSET_PATH + asset_path
+    for name, names in manifest.get('groups', {}).items():
+        _groups[name] = tuple(names)
+
+    load_atlas()
+
+
+def load_atlas(path=ATLAS):
+    ''' Read the atlas index, if one has been packed. Images whose source
+    has changed since are loaded from their own file instead. '''
+    try:
+        with open(path) as atlas_file:
+            atlas = json.load(atlas_file)
+    except (IOError, OSError, ValueError):
+        return
+
+    _atlas_paths[:] = [config.ASSET_PATH + sheet for sheet in atlas['sheets']]
+    for name, entry in atlas['images'].items():
+        source = config.ASSET_PATH + entry['source']
+        try:
+            current = _image_paths.get(name) == source and \
+                os.stat(source).st_mtime == entry['mtime']
+        except OSError:
+            current = False
+
+        if current:
+            _atlas_rects[name] = (entry['sheet'], pygame.Rect(entry['rect']))
+        else:
+            print('[WARNING] atlas out of date, run pack_atlas.py: ' + name)
+
+
+def pack_atlas(output=ATLAS, sheet_size=ATLAS_SHEET_SIZE):
+    ''' Pack every manifest image outside a group onto as few sheets as
+    shelf packing allows and write the sheets and their index. Needs a
+    display mode set for convert_alpha. Returns the sheet paths. '''
+    grouped = set(name for names in _groups.values() for name in names)
+    images = []
+    for name, path in _image_paths.items():
+        if name in grouped or not path.startswith(config.ASSET_PATH):
+            continue
+        image = pygame.image.load(path).convert_alpha()
+        if image.get_width() > sheet_size or image.get_height() > sheet_size:
+            continue  # Stays in its own file
+        images.append((name, path, image))
+
+    # Tallest first, so each shelf wastes little height
+    images.sort(key=lambda item: (-item[2].get_height(), -item[2].get_width(),
+                                  item[0]))
+
+    sheets = [[]]  # per sheet: [(name, path, image, x, y)]
+    x = y = shelf_height = 0
+    for name, path, image in images:
+        width, height = image.get_size()
+        if x + width > sheet_size:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        if y + height > sheet_size:
+            sheets.append([])
+            x = y = shelf_height = 0
+        sheets[-1].append((name, path, image, x, y))
+        x += width
+        shelf_height = max(shelf_height, height)
+
+    index = {'sheets': [], 'images': {}}
+    sheet_paths = []
+    for i, placed in enumerate(sheets):
+        if not placed:
+            continue
+        sheet_name = ATLAS_SHEET % i
+        height = max(y + image.get_height() for _, _, image, _, y in placed)
+        sheet = pygame.Surface((sheet_size, height), pygame.SRCALPHA)
+        sheet.fill((0, 0, 0, 0))
+        for name, path, image, x, y in placed:
+            # Blending onto a clear sheet would darken translucent pixels,
+            # RGBA_MAX copies them as they are
+            sheet.blit(image, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+            index['images'][name] = {
+                'sheet': len(index['sheets']),
+                'rect': [x, y, image.get_width(), image.get_height()],
+                'source': path[len(config.ASSET_PATH):],
+                'mtime': os.stat(path).st_mtime
+            }
+        sheet_path = config.ASSET_PATH + sheet_name
+        pygame.image.save(sheet, sheet_path)
+        index['sheets'].append(sheet_name)
+        sheet_paths.append(sheet_path)
+
+    with open(output, 'w') as atlas_file:
+        json.dump(index, atlas_file, indent=4, sort_keys=True)
+    return sheet_paths
+
+
+def get_image(name):
+    image = _images.get(name)
+    if image is None and name in _atlas_rects:
+        sheet_index, rect = _atlas_rects[name]
+        sheet = _atlas_sheets.get(sheet_index)
+        if sheet is None:
+            sheet = display_format(pygame.image.load(_atlas_paths[sheet_index]))
+            _atlas_sheets[sheet_index] = sheet
+        image = sheet.subsurface(rect)
+        _images[name] = image
+    elif image is None:
+        path = _image_paths.get(name)
+        if path is None:
+            print('[WARNING] image not in manifest: ' + name)
+            return None
+        image = display_format(pygame.image.load(path), _colorkeys.get(name))
+        _images[name] = image
+    return image
+
+
+def get_sound(name):
+    sound = _sounds.get(name)
+    if sound is None:
+        path = _sound_paths.get(name)
+        if path is None:
+            print('[WARNING] sound not in manifest: ' + name)
+            return None
+        try:
+            sound = pygame.mixer.Sound(path)
+        except pygame.error:
+            print('[ERROR] could not load sound: ' + path)
+            return None
+        _sounds[name] = sound
+    return sound
+
+
+def load_image(path, colorkey=None):
+    ''' Load an image outside the manifest, such as a stage's tileset. It is
+    cached, acquired and released under image_name(path), so stages naming
+    different files alike never share an image. '''
+    name = image_name(path)
+    _image_paths[name] = name
+    if colorkey is not None:
+        _colorkeys[name] = colorkey
+    return get_image(name)
+
+
+def image_name(path):
+    ''' The name an image outside the manifest is kept under '''
+    return os.path.normpath(path)
+
+
+def display_format(image, colorkey=None):
+    ''' image converted to the display's pixel format. colorkey is drawn
+    clear, unless the file has transparency of its own (some stages give
+    tilesets a trans color the image doesn't use). Images whose alpha is
+    only ever 0 or 255 are colorkeyed with COLORKEY instead, so only images
+    with partly transparent pixels keep per-pixel alpha. '''
+    has_alpha = image.get_flags() & pygame.SRCALPHA
+    if colorkey is not None and not has_alpha and image.get_colorkey() is None:
+        image = image.convert()
+        image.set_colorkey(colorkey, pygame.RLEACCEL)
+        return image
+    elif not has_alpha:
+        return image.convert()  # keeps a colorkey set by the file
+
+    area = image.get_width() * image.get_height()
+    opaque = pygame.mask.from_surface(image, 254)
+    if opaque.count() == area:
+        image = image.convert()
+        image.set_alpha(None)
+        return image
+    elif opaque.count() == pygame.mask.from_surface(image, 0).count():
+        keyed = _colorkeyed(image, opaque)
+        if keyed is not None:
+            return keyed
+    return image.convert_alpha()
+
+
+def reconvert():
+    ''' Convert every loaded image to the display's current pixel format,
+    after the display has been recreated. Surfaces fetched before keep the
+    old format until they are fetched again. '''
+    for index, sheet in _atlas_sheets.items():
+        _atlas_sheets[index] = display_format(sheet)
+    for name, image in _images.items():
+        if name in _atlas_rects:
+            sheet_index, rect = _atlas_rects[name]
+            _images[name] = _atlas_sheets[sheet_index].subsurface(rect)
+        else:
+            _images[name] = display_format(image)
+
+
+def _colorkeyed(image, opaque):
+    # Clear pixels become COLORKEY, unless an opaque pixel already uses it.
+    # Opaque pixels blit unblended, so their colors come through exact.
+    uses_key = pygame.mask.from_threshold(image, COLORKEY + (255,),
+                                          (1, 1, 1, 255))
+    if uses_key.overlap_area(opaque, (0, 0)):
+        return None
+
+    keyed = pygame.Surface(image.get_size()).convert()
+    keyed.fill(COLORKEY)
+    keyed.blit(image, (0, 0))
+    keyed.set_colorkey(COLORKEY, pygame.RLEACCEL)
+    return keyed
+
+
+def group(name):
+    return _groups.get(name, ())
+
+
+def acquire(names):
+    for name in names:
+        _references[name] = _references.get(name, 0) + 1
+
+
+def release(names):
+    for name in names:
+        count = _references.get(name, 0) - 1
+        if count > 0:
+            _references[name] = count
+        else:
+            _references.pop(name, None)
+            _images.pop(name, None)
+            _sounds.pop(name, None)
+
+
+def image_bytes():
+    # Atlas images share their sheet's pixels, count the sheets instead
+    surfaces = [image for name, image in _images.items()
+                if name not in _atlas_rects]
+    surfaces.extend(_atlas_sheets.values())
+    return sum(image.get_width() * image.get_height() * image.get_bytesize()
+               for image in surfaces)
+
+
+def stats():
+    return '%d images, %d sounds, %d acquired, %d KB' % \
+        (len(_images), len(_sounds), len(_references), image_bytes() // 1024)
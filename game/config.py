@@ -17,5 +17,9 @@ KEY = {
 }
 
 SCALE = 4
+
+# Memory budget, in bytes, for parsed stages kept between room transitions
+STAGE_CACHE_SIZE = 8 * 1024 * 1024
+
 WINDOW_HEIGHT = 256
 WINDOW_WIDTH = 160
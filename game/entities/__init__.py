@@ -1,13 +1,17 @@
+import operator
+
 import peachy
 from peachy import PC
 from peachy.graphics import splice
 
+from game import assets
 from game.config import SAVE_FILE
 
 from .enemy import Enemy
 from .player import Player
 from .projectile import Projectile
 from .skeleton import Skeleton
+from .slug import ResourceSlugHive
 from .goblin import *
 from .utility import GRAVITY, MAX_GRAVITY, collision_resolution, \
     xcollides_solid, solid_below
@@ -31,6 +35,9 @@ def display_message(message):
 
 class AbsClimbable(peachy.Entity):
 
+    STAGE_OBJECT = 'CLIMB'
+    STAGE_ARGS = ('h',)
+
     def __init__(self, x, y, height):
         super().__init__(x, y)
         self.group = 'climbable'
@@ -47,6 +54,9 @@ class AbsClimbable(peachy.Entity):
 
 class ArrowTrap(peachy.Entity):
 
+    STAGE_OBJECT = 'ARROW_TRAP'
+    STAGE_ARGS = ('DIRECTION',)
+
     ARROW_COOLDOWN = 90
 
     def __init__(self, x, y, direction):
@@ -127,6 +137,8 @@ class ArrowTrap(peachy.Entity):
 
 class Bat(Enemy):
 
+    STAGE_OBJECT = 'BAT'
+
     ACCEL_SPEED = 0.05
     SPEED = 0.75
 
@@ -234,6 +246,9 @@ class Boulder(peachy.Entity):
 
 class BoulderSpawner(peachy.Entity):
 
+    STAGE_OBJECT = 'BOULDER_SPAWNER'
+    STAGE_ARGS = ('DIRECTION',)
+
     SPAWN_DELAY = 80
 
     def __init__(self, x, y, direction):
@@ -268,6 +283,8 @@ class BoulderSpawner(peachy.Entity):
 
 class BreakableTile(peachy.Entity):
 
+    STAGE_OBJECT = 'BREAKABLE'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.group = 'breakable'
@@ -276,7 +293,7 @@ class BreakableTile(peachy.Entity):
         self.width = 16
         self.height = 16
 
-        self.sprite = peachy.fs.get_image('BREAKABLE_TILE')
+        self.sprite = assets.get_image('BREAKABLE_TILE')
 
     def render(self):
         peachy.graphics.draw(self.sprite, self.x, self.y)
@@ -284,6 +301,9 @@ class BreakableTile(peachy.Entity):
 
 class BreakableReinforcedTile(peachy.Entity):
 
+    STAGE_OBJECT = 'BREAKABLE_REINFORCED'
+    STAGE_ARGS = ('w', 'h')
+
     def __init__(self, x, y, width, height):
         super().__init__(x, y)
         self.group = 'breakable-reinforced'
@@ -299,6 +319,9 @@ class BreakableReinforcedTile(peachy.Entity):
 
 class Dasher(Enemy):
 
+    STAGE_OBJECT = 'DASHER'
+    STAGE_ARGS = ('DIRECTION',)
+
     ACCEL_SPEED = 0.05
     SPEED = 1
 
@@ -324,7 +347,7 @@ class Dasher(Enemy):
         elif initial_direction == 'DOWN':
             self.direction_y = 1
 
-        spritesheet = peachy.fs.get_image('DASHER')
+        spritesheet = assets.get_image('DASHER')
 
         if self.direction_y != 0:
             spritesheet = peachy.graphics.rotate(spritesheet, 270)
@@ -368,6 +391,9 @@ class Dasher(Enemy):
 
 class Door(peachy.Entity):
 
+    STAGE_OBJECT = 'DOOR'
+    STAGE_ARGS = ('LINK',)
+
     sprite = None
 
     def __init__(self, x, y, link):
@@ -380,7 +406,7 @@ class Door(peachy.Entity):
         self.link = link
 
         if Door.sprite is None:
-            Door.sprite = peachy.fs.get_image('DOOR')
+            Door.sprite = assets.get_image('DOOR')
 
     def render(self):
         peachy.graphics.draw(Door.sprite, self.x, self.y - 8)
@@ -388,6 +414,9 @@ class Door(peachy.Entity):
 
 class Item(peachy.Entity):
 
+    STAGE_OBJECT = 'ITEM'
+    STAGE_ARGS = ('GLOBAL_ID', 'ITEM_TYPE', 'VALUE')
+
     def __init__(self, x, y, global_id, item_type, value):
         super().__init__(x, y)
         self.group = 'interactable'
@@ -398,7 +427,7 @@ class Item(peachy.Entity):
         self.item_type = item_type
         self.value = value
 
-        sprites = splice(peachy.fs.get_image('UPGRADES'), 16, 16)
+        sprites = splice(assets.get_image('UPGRADES'), 16, 16)
 
         if item_type == 'HEALTH_UPGRADE':
             self.sprite = sprites[0]
@@ -449,6 +478,8 @@ class MapEvent(peachy.Entity):
 
 class MovingPlatform(peachy.Entity):
 
+    STAGE_OBJECT = 'MOVING_PLATFORM'
+
     SPEED = 1
     ZONE_SIZE = 2
     WAIT_TIME = 60
@@ -472,7 +503,13 @@ class MovingPlatform(peachy.Entity):
         self.waiting = False
         self.wait_timer = 0
 
-        self.sprite = peachy.fs.get_image('MOVING_PLATFORM')
+        self.sprite = assets.get_image('MOVING_PLATFORM')
+
+    @staticmethod
+    def from_stage_object(OBJ):
+        end_x = OBJ.x + OBJ.polygon_points[1].x
+        end_y = OBJ.y + OBJ.polygon_points[1].y
+        return MovingPlatform(OBJ.x, OBJ.y, end_x, end_y)
 
     def render(self):
         if PC.debug and peachy.utils.Keys.down('g'):
@@ -567,6 +604,9 @@ class MovingPlatform(peachy.Entity):
 
 class Platform(peachy.Entity):
 
+    STAGE_OBJECT = 'PLATFORM'
+    STAGE_ARGS = ('w',)
+
     def __init__(self, x, y, width):
         super().__init__(x, y)
         self.group = 'platform'
@@ -590,6 +630,8 @@ class Platform(peachy.Entity):
 
 class PressurePlate(peachy.Entity):
 
+    STAGE_OBJECT = 'PRESSURE_PLATE'
+
     def __init__(self, x, y, on_activate, on_deactivate):
         super().__init__(x, y)
         self.width = 16
@@ -600,6 +642,13 @@ class PressurePlate(peachy.Entity):
         self.on_activate = on_activate
         self.on_deactivate = on_deactivate
 
+    @staticmethod
+    def from_stage_object(OBJ):
+        # Plates sit on the floor at the bottom of their 16px tile
+        return PressurePlate(OBJ.x, OBJ.y + 12,
+                             OBJ.properties['ON_ACTIVATE'],
+                             OBJ.properties['ON_DEACTIVATE'])
+
     def render(self):
         peachy.graphics.set_color(255, 120, 0)
         peachy.graphics.draw_rect(self.x, self.y, self.width, self.height)
@@ -612,7 +661,7 @@ class PressurePlate(peachy.Entity):
 
     def update(self):
         is_pressed_down = False
-        collisions = self.collides_solid()
+        collisions = self.container.collides_solid(self)
         collisions.append(self.collides_name('player'))
 
         for c in collisions:
@@ -630,6 +679,9 @@ class PressurePlate(peachy.Entity):
 
 class RetractableDoor(peachy.Entity):
 
+    STAGE_OBJECT = 'RETRACTABLE_DOOR'
+    STAGE_ARGS = ('w', 'h')
+
     def __init__(self, x, y, width, height):
         super().__init__(x, y)
         self.width = width
@@ -652,13 +704,15 @@ class RetractableDoor(peachy.Entity):
 
 class SaveStation(peachy.Entity):
 
+    STAGE_OBJECT = 'SAVE_POINT'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.group = 'interactable'
         self.width = 16
         self.height = 16
 
-        self.sprite = peachy.fs.get_image('SAVE_STATION')
+        self.sprite = assets.get_image('SAVE_STATION')
 
     def render(self):
         peachy.graphics.draw(self.sprite, self.x, self.y)
@@ -674,6 +728,8 @@ class SaveStation(peachy.Entity):
 
 class Ship(peachy.Entity):
 
+    STAGE_OBJECT = 'SHIP'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.group = 'interactable'
@@ -691,6 +747,9 @@ class Ship(peachy.Entity):
 
 class SignPost(peachy.Entity):
 
+    STAGE_OBJECT = 'SIGN'
+    STAGE_ARGS = ('MESSAGE',)
+
     def __init__(self, x, y, message):
         super().__init__(x, y)
         self.width = 16
@@ -698,7 +757,7 @@ class SignPost(peachy.Entity):
 
         self.message = message
 
-        self.sprite = peachy.fs.get_image('SIGN_POST')
+        self.sprite = assets.get_image('SIGN_POST')
 
     def render(self):
         if self.container.planet['name'] != 'reptilia':
@@ -711,6 +770,8 @@ class SignPost(peachy.Entity):
 class SmallGolem(Enemy):
     """ Walks towards the player"""
 
+    STAGE_OBJECT = 'SMALL_GOLEM'
+
     SPEED = 1
 
     def __init__(self, x, y):
@@ -718,7 +779,7 @@ class SmallGolem(Enemy):
         self.width = 10
         self.height = 10
 
-        self.sprite = peachy.fs.get_image('SMALL_GOLEM')
+        self.sprite = assets.get_image('SMALL_GOLEM')
 
         self.facing_x = 0
 
@@ -773,6 +834,30 @@ class Solid(peachy.Entity):
         self.flip_x = flip_x
         self.flip_y = flip_y
 
+    @staticmethod
+    def from_stage_object(OBJ):
+        if not OBJ.is_polygon:
+            return Solid(OBJ.x, OBJ.y, OBJ.w, OBJ.h)
+
+        # Slopes are right triangles, sized by their polygon points
+        x = OBJ.x
+        y = OBJ.y
+        w = 0
+        h = 0
+        flip_x = True
+
+        for point in OBJ.polygon_points:
+            if point.x != 0:
+                if w != 0:
+                    flip_x = False
+                w = abs(point.x)
+            if point.y != 0:
+                h = abs(point.y)
+                if point.y < 0:
+                    y -= h
+
+        return Solid(x, y, w, h, True, flip_x)
+
     def intersection(self, line_x):
 
         line_x = line_x - self.x
@@ -801,6 +886,8 @@ class Solid(peachy.Entity):
 
 class Spider(Enemy):
 
+    STAGE_OBJECT = 'SPIDER'
+
     ACCEL_SPEED = 0.25
     MOVE_SPEED = 1.5
 
@@ -874,6 +961,10 @@ class Spider(Enemy):
 
 
 class Spikes(peachy.Entity):
+
+    STAGE_OBJECT = 'SPIKES'
+    STAGE_ARGS = ('w',)
+
     def __init__(self, x, y, width):
         super().__init__(x, y)
 
@@ -894,6 +985,9 @@ class Spikes(peachy.Entity):
 
 class Switch(peachy.Entity):
 
+    STAGE_OBJECT = 'SWITCH'
+    STAGE_ARGS = ('ON_ACTIVATE',)
+
     def __init__(self, x, y, on_activate):
         super().__init__(x, y)
         self.group = 'switch'
@@ -905,7 +999,7 @@ class Switch(peachy.Entity):
         self.activated = False
         self.on_activate = on_activate
 
-        self.sprite = peachy.graphics.SpriteMap(peachy.fs.get_image('SWITCH'),
+        self.sprite = peachy.graphics.SpriteMap(assets.get_image('SWITCH'),
                                                 16, 16)
         self.sprite.add('ON', [1])
         self.sprite.add('OFF', [0])
@@ -922,6 +1016,9 @@ class Switch(peachy.Entity):
 
 class Water(peachy.Entity):
 
+    STAGE_OBJECT = 'WATER'
+    STAGE_ARGS = ('w', 'h')
+
     def __init__(self, x, y, width, height):
         super().__init__(x, y)
         self.group = 'water'
@@ -935,6 +1032,8 @@ class Water(peachy.Entity):
 
 class Weight(peachy.Entity):
 
+    STAGE_OBJECT = 'WEIGHT'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.group = 'weight'
@@ -943,7 +1042,7 @@ class Weight(peachy.Entity):
         self.height = 16
         self.solid = True
 
-        self.sprite = peachy.fs.get_image('WEIGHT')
+        self.sprite = assets.get_image('WEIGHT')
 
     def render(self):
         peachy.graphics.draw(self.sprite, self.x, self.y)
@@ -953,3 +1052,32 @@ class Weight(peachy.Entity):
         self.velocity_y += GRAVITY if self.velocity_y < MAX_GRAVITY else 0
         temp_y += self.velocity_y
         _, self.x, self.y, _, _ = collision_resolution(self, self.x, temp_y)
+
+
+def stage_object_factory(entity_class):
+    ''' Build entity_class from a Tiled object. Constructor arguments after x
+    and y are declared by entity_class.STAGE_ARGS: lowercase names are read
+    from the object (w, h), uppercase names from its properties. '''
+    getters = []
+    for arg in getattr(entity_class, 'STAGE_ARGS', ()):
+        if arg.islower():
+            getters.append(operator.attrgetter(arg))
+        else:
+            getters.append(lambda OBJ, key=arg: OBJ.properties[key])
+
+    def factory(OBJ):
+        return entity_class(OBJ.x, OBJ.y, *[get(OBJ) for get in getters])
+    return factory
+
+
+# Tiled object name -> factory(OBJ) returning a new entity. Any class in this
+# package that declares STAGE_OBJECT is registered; classes that need more than
+# their declared STAGE_ARGS provide from_stage_object instead.
+OBJECT_FACTORIES = {}
+for _entity_class in list(globals().values()):
+    if isinstance(_entity_class, type) and \
+       'STAGE_OBJECT' in vars(_entity_class):
+        OBJECT_FACTORIES[_entity_class.STAGE_OBJECT] = \
+            getattr(_entity_class, 'from_stage_object', None) or \
+            stage_object_factory(_entity_class)
+del _entity_class
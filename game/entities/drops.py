@@ -6,15 +6,23 @@ from peachy import PC
 from .player import Player
 import random
 
+# Drops roll on their own generator, so a recording's seed reproduces them
+# on replay (see game/playback.py)
+rng = random.Random()
+
+
+def seed(value):
+    rng.seed(value)
+
 
 def drop(x, y, drop_rate=25, missile_rate=20):
     # 25% chance to drop
-    success = random.randint(0, 99) < drop_rate
+    success = rng.randint(0, 99) < drop_rate
     if success:
         drop = None
         player = PC.world.entities.get_name('player')
         if Player.Item.ID_MISSILE in player.items:
-            success = random.randint(0, 99) < missile_rate
+            success = rng.randint(0, 99) < missile_rate
             if success:
                 drop = AmmoDrop(x, y)
             else:
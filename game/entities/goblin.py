@@ -6,6 +6,8 @@ from .utility import MAX_GRAVITY, GRAVITY, collision_resolution, solid_below
 
 class GoblinImp(Enemy):
 
+    STAGE_OBJECT = 'GOBLIN_IMP'
+
     JUMP_COOLDOWN = 90
     AIR_SPEED = 2.75
     MOVE_SPEED = 0.5
@@ -148,6 +150,8 @@ class GoblinSpearman(Enemy):
 
 class GoblinSwordsman(Enemy):
 
+    STAGE_OBJECT = 'GOBLIN_SWORDSMAN'
+
     MOVE_SPEED = 1
     ACCEL_SPEED = 0.2
 
@@ -2,7 +2,7 @@ import peachy
 from peachy import PC
 from peachy.utils import Key
 
-from game import config
+from game import assets, config
 
 from .utility import GRAVITY, MAX_GRAVITY, collision_resolution, \
     solid_below, xcollides_solid, knockback
@@ -357,7 +357,7 @@ class Player(peachy.Entity):
     class Sprite(object):
 
         def __init__(self):
-            spritesheet = peachy.fs.get_image('PLAYER')
+            spritesheet = assets.get_image('PLAYER')
 
             self.anim_name = 'IDLE'
             self.set_name = Player.Item.ID_FIST
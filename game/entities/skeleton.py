@@ -1,4 +1,7 @@
 import peachy
+
+from game import assets
+
 from .enemy import Enemy
 from .player import Player
 from .projectile import Projectile
@@ -7,6 +10,8 @@ from .utility import GRAVITY, MAX_GRAVITY, collision_resolution, solid_below
 
 class Skeleton(Enemy):
 
+    STAGE_OBJECT = 'SKELETON'
+
     BONE_COOLDOWN = 90
     SPEED = Player.WALK_MAX_SPEED + 0.5
     SAFE_DISTANCE = 54
@@ -20,7 +25,7 @@ class Skeleton(Enemy):
 
         self.bone_cooldown = Skeleton.BONE_COOLDOWN
 
-        self.sprite = peachy.fs.get_image('SKELETON')
+        self.sprite = assets.get_image('SKELETON')
 
     def render(self):
         if self.facing_x == 1:
@@ -1,6 +1,7 @@
 import peachy
+from .drops import drop
 from .enemy import Enemy
-from .utility import drop, solid_above, solid_below, solid_left, solid_right, \
+from .utility import solid_above, solid_below, solid_left, solid_right, \
     collision_resolution
 
 
@@ -80,6 +81,9 @@ class ResourceSlug(Enemy):
 
 class ResourceSlugHive(peachy.Entity):
 
+    STAGE_OBJECT = 'RESOURCE_SLUG_HIVE'
+    STAGE_ARGS = ('ORIENTATION', 'DIRECTION')
+
     SPAWN_CAP = 5
     SPAWN_TIME = 135
 
@@ -1,11 +1,19 @@
 import peachy
 
+from game import text
+
 # Entity constants
 INVINCIBILITY_DURATION = 20
 GRAVITY = 0.2
 MAX_GRAVITY = 6
 
 
+def _coordinates(entity, x, y):
+    if x is None or y is None:
+        return entity.x, entity.y
+    return x, y
+
+
 def collision_resolution(entity, temp_x, temp_y):
 
     # TODO fix spacing. for some reason certain collisions allow for a gap
@@ -14,7 +22,7 @@ def collision_resolution(entity, temp_x, temp_y):
     vel_x = entity.velocity_x
     vel_y = entity.velocity_y
 
-    collisions = entity.collides_solid(temp_x, temp_y)
+    collisions = entity.container.collides_solid(entity, temp_x, temp_y)
     for collision in collisions:
 
         if not entity.collides(collision, temp_x, temp_y):
@@ -79,7 +87,7 @@ def draw_message(player, message):
     peachy.graphics.set_color(0, 30, 60)
     peachy.graphics.draw_rect(0, y, peachy.PC.width, HEIGHT)
     peachy.graphics.set_color(255, 255, 255)
-    peachy.graphics.draw_text(message, 8, y + 8)
+    text.draw(message, 8, y + 8)
 
 
 def get_line_segments(entity):
@@ -127,20 +135,24 @@ def raycast(sx, sy, ex, ey, obstructions):
     return True
 
 
-def solid_above(entity, x, y):
-    return entity.collides_solid(x, y - 1)
+def solid_above(entity, x=None, y=None):
+    x, y = _coordinates(entity, x, y)
+    return entity.container.collides_solid(entity, x, y - 1)
 
 
-def solid_below(entity, x, y):
-    return entity.collides_solid(x, y + 1)
+def solid_below(entity, x=None, y=None):
+    x, y = _coordinates(entity, x, y)
+    return entity.container.collides_solid(entity, x, y + 1)
 
 
-def solid_left(entity, x, y):
-    return entity.collides_solid(x - 1, y)
+def solid_left(entity, x=None, y=None):
+    x, y = _coordinates(entity, x, y)
+    return entity.container.collides_solid(entity, x - 1, y)
 
 
-def solid_right(entity, x, y):
-    return entity.collides_solid(x + 1, y)
+def solid_right(entity, x=None, y=None):
+    x, y = _coordinates(entity, x, y)
+    return entity.container.collides_solid(entity, x + 1, y)
 
 
 def string_escape(string):
@@ -148,9 +160,10 @@ def string_escape(string):
     return bytes(string, 'utf-8').decode('unicode-escape')
 
 
-def xcollides_solid(entity, x, y):
+def xcollides_solid(entity, x=None, y=None):
     # collision detection procedure that includes slanted solids
-    collisions_raw = entity.collides_solid(x, y)
+    x, y = _coordinates(entity, x, y)
+    collisions_raw = entity.container.collides_solid(entity, x, y)
     collisions = []
     for collision in collisions_raw:
         if collision.member_of('solid') and collision.slanted:
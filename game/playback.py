@@ -0,0 +1,244 @@
+''' Keyboard input from a script or a recording rather than the keyboard,
+so the game can run without anyone at it. Once installed, ScriptedKeys
+answers the game's Key.down, Key.pressed and Key.released calls from the
+keys its script holds on the current tick.
+
+Scripts are text, one change per line: the tick it takes effect on, then
+every key held from that tick on, by config.KEY binding or key name.
+
+    # tick  keys
+    0       RIGHT
+    40      RIGHT JUMP
+    48      RIGHT
+    200
+
+Recordings hold the config.KEY keys down on each tick from a fresh load of
+a stage, along with the seed drops were rolled with, the player's state and
+the room's flags, so replaying one repeats the run tick for tick. They are
+saved as binary logs:
+
+    header  '<4sBIddhhh': MAGIC, VERSION, seed, player x and y (NaN for the
+            stage's debug spawn), health, max health and ammo (-1 for a new
+            player's), then the stage path, the key names, the player's
+            items and the room's flags, each a '<H' length and UTF-8, the
+            last three after a '<H' count
+    ticks   '<I' count of runs, then '<HH' per run: the keys held as a mask,
+            bit n for key n, and how many ticks they were held for '''
+import math
+import struct
+
+import peachy
+
+from game import config
+
+MAGIC = b'OYRL'
+VERSION = 2
+
+# Every bound key, in mask bit order
+KEYS = tuple(sorted(set(config.KEY.values())))
+
+_HEADER = struct.Struct('<4sBIddhhh')
+_COUNT = struct.Struct('<H')
+_RUN_COUNT = struct.Struct('<I')
+_RUN = struct.Struct('<HH')
+MAX_KEYS = 16      # bits in a run's mask
+MAX_RUN = 0xffff   # ticks in a run, longer holds take more than one
+
+
+def load_script(path):
+    ''' [(tick, frozenset of key names)] in tick order '''
+    script = []
+    with open(path) as script_file:
+        for number, line in enumerate(script_file, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+
+            try:
+                tick = int(fields[0])
+            except ValueError:
+                raise ValueError('%s:%d: expected a tick, got %r' %
+                                 (path, number, fields[0]))
+            keys = frozenset(config.KEY.get(key, key) for key in fields[1:])
+            script.append((tick, keys))
+
+    script.sort(key=lambda change: change[0])
+    return script
+
+
+def _pack_string(text):
+    data = text.encode('utf-8')
+    return _COUNT.pack(len(data)) + data
+
+
+def _unpack_string(data, offset):
+    length, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+class Recording(object):
+
+    def __init__(self, stage, seed, x=None, y=None, items=(), keys=KEYS,
+                 health=None, max_health=None, ammo=None, flags=()):
+        if len(keys) > MAX_KEYS:
+            raise ValueError('at most %d keys can be recorded' % MAX_KEYS)
+
+        self.stage = stage  # path under assets/, as rooms load it
+        self.seed = seed
+        self.x = x          # player start, None for the debug spawn
+        self.y = y
+        self.items = list(items)
+        self.keys = tuple(keys)
+
+        # Player and room state to restart from, None for a new player's
+        self.health = health
+        self.max_health = max_health
+        self.ammo = ammo
+        self.flags = list(flags)
+
+        self.runs = []      # [mask, ticks]
+
+    @property
+    def ticks(self):
+        return sum(length for _, length in self.runs)
+
+    def capture(self):
+        ''' Log the keys peachy.utils.Key has down this tick '''
+        mask = 0
+        for bit, key in enumerate(self.keys):
+            if peachy.utils.Key.down(key):
+                mask |= 1 << bit
+
+        runs = self.runs
+        if runs and runs[-1][0] == mask and runs[-1][1] < MAX_RUN:
+            runs[-1][1] += 1
+        else:
+            runs.append([mask, 1])
+
+    def script(self):
+        ''' The recorded keys as a ScriptedKeys script '''
+        script = []
+        tick = 0
+        for mask, length in self.runs:
+            keys = frozenset(key for bit, key in enumerate(self.keys)
+                             if mask & 1 << bit)
+            script.append((tick, keys))
+            tick += length
+        return script
+
+    def save(self, path):
+        x = float('nan') if self.x is None else self.x
+        y = float('nan') if self.y is None else self.y
+        player = [-1 if value is None else value
+                  for value in (self.health, self.max_health, self.ammo)]
+
+        parts = [_HEADER.pack(MAGIC, VERSION, self.seed, x, y, *player),
+                 _pack_string(self.stage)]
+        for strings in (self.keys, self.items, self.flags):
+            parts.append(_COUNT.pack(len(strings)))
+            parts.extend(_pack_string(string) for string in strings)
+
+        parts.append(_RUN_COUNT.pack(len(self.runs)))
+        parts.extend(_RUN.pack(mask, length) for mask, length in self.runs)
+
+        with open(path, 'wb') as log_file:
+            log_file.write(b''.join(parts))
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as log_file:
+            data = log_file.read()
+
+        try:
+            magic, version, seed, x, y, *player = _HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a version %d recording' %
+                                 (path, VERSION))
+            stage, offset = _unpack_string(data, _HEADER.size)
+
+            lists = []
+            for _ in range(3):
+                count, = _COUNT.unpack_from(data, offset)
+                offset += _COUNT.size
+                strings = []
+                for _ in range(count):
+                    string, offset = _unpack_string(data, offset)
+                    strings.append(string)
+                lists.append(strings)
+            keys, items, flags = lists
+
+            count, = _RUN_COUNT.unpack_from(data, offset)
+            offset += _RUN_COUNT.size
+            runs = [list(_RUN.unpack_from(data, offset + i * _RUN.size))
+                    for i in range(count)]
+        except struct.error:
+            raise ValueError('%s is truncated' % path)
+
+        if math.isnan(x):
+            x = y = None
+        health, max_health, ammo = [None if value == -1 else value
+                                    for value in player]
+        recording = Recording(stage, seed, x, y, items, keys,
+                              health, max_health, ammo, flags)
+        recording.runs = runs
+        return recording
+
+
+class ScriptedKeys(object):
+    ''' With keys given, only those are answered from the script, and the
+    rest from the keyboard as before '''
+
+    def __init__(self, script=(), keys=None):
+        self.script = list(script)
+        self.keys = None if keys is None else frozenset(keys)
+        self.tick = 0
+        self.current = frozenset()
+        self.previous = frozenset()
+
+        self._next_change = 0
+        self._replaced = {}  # Key attribute -> original, while installed
+
+    def down(self, key):
+        if self._passed_through(key):
+            return self._replaced['down'].__func__(key)
+        return key in self.current
+
+    def pressed(self, key):
+        if key == 'any':
+            return bool(self.current - self.previous) or \
+                (self.keys is not None and
+                 self._replaced['pressed'].__func__(key))
+        if self._passed_through(key):
+            return self._replaced['pressed'].__func__(key)
+        return key in self.current and key not in self.previous
+
+    def released(self, key):
+        if self._passed_through(key):
+            return self._replaced['released'].__func__(key)
+        return key in self.previous and key not in self.current
+
+    def install(self):
+        Key = peachy.utils.Key
+        for name in ('down', 'pressed', 'released'):
+            self._replaced[name] = Key.__dict__[name]
+            setattr(Key, name, staticmethod(getattr(self, name)))
+
+    def uninstall(self):
+        Key = peachy.utils.Key
+        for name, original in self._replaced.items():
+            setattr(Key, name, original)
+        self._replaced.clear()
+
+    def _passed_through(self, key):
+        return self.keys is not None and key not in self.keys
+
+    def step(self):
+        ''' Move on to the next tick's keys, once before each update '''
+        self.previous = self.current
+        script = self.script
+        while self._next_change < len(script) and \
+                script[self._next_change][0] <= self.tick:
+            self.current = script[self._next_change][1]
+            self._next_change += 1
+        self.tick += 1
@@ -0,0 +1,169 @@
+''' Per-frame timings of the room's systems, for debug mode. While enabled,
+sections are timed into the current frame, and end_frame() moves the frame's
+totals into a rolling window of HISTORY frames for percentiles. The overlay
+lists each section's last, p50, p95 and p99 milliseconds; recording keeps
+every frame until it is written out as a CSV file.
+
+peachy's loop polls input, scales and flips the display out of reach of the
+game, so their time, along with the frame rate cap's idle time, shows up as
+'other': the frame's total length less everything timed in it. '''
+import csv
+import time
+from collections import deque
+
+import peachy
+
+from game import text
+
+HISTORY = 270  # frames, six seconds at 45 Hz
+PERCENTILES = (50, 95, 99)
+REFRESH = 15   # frames between overlay refreshes, keeps it readable
+MAX_LINES = 12 # sections listed on the overlay, slowest first
+
+# Sections nested inside another, left out when working out 'other'
+NESTED = ('collision', 'update:')
+
+enabled = False
+recording = False
+
+_history = {}      # section -> deque of ms per frame
+_frame = {}        # section -> ms so far this frame
+_frame_start = None
+_frames = 0
+_lines = []        # overlay rows of text, refreshed every REFRESH frames
+_rows = []         # recorded frames, section -> ms
+
+
+def add(section, seconds):
+    _frame[section] = _frame.get(section, 0.0) + seconds * 1000.0
+
+
+def toggle():
+    global enabled, _frame_start
+    enabled = not enabled
+    _history.clear()
+    _frame.clear()
+    _lines[:] = []
+    _frame_start = None
+    if not enabled and recording:
+        stop_recording()
+
+
+def start_recording():
+    ''' Keep every frame from the next end_frame() on. '''
+    global recording, _frame_start
+    if not enabled:
+        toggle()
+    recording = True
+    _rows[:] = []
+    _frame.clear()
+    _frame_start = None
+
+
+def stop_recording(path=None):
+    ''' Write the recorded frames to path, one row per frame and a column
+    per section. Returns the path written, if anything was recorded. '''
+    global recording
+    recording = False
+    if not _rows:
+        return None
+
+    if path is None:
+        path = time.strftime('profile_%Y%m%d_%H%M%S.csv')
+
+    sections = sorted(set().union(*_rows))
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, ['frame'] + sections, restval=0)
+        writer.writeheader()
+        for frame, row in enumerate(_rows):
+            row['frame'] = frame
+            writer.writerow(row)
+
+    print('[LOG] profiler: %d frames written to %s' % (len(_rows), path))
+    _rows[:] = []
+    return path
+
+
+def recorded():
+    ''' Frames recorded so far, section -> ms. '''
+    return list(_rows)
+
+
+def end_frame():
+    ''' Close the current frame, timing it from the previous call. '''
+    global _frame_start, _frames
+
+    now = time.perf_counter()
+    if _frame_start is not None:
+        frame = (now - _frame_start) * 1000.0
+        timed = sum(ms for section, ms in _frame.items()
+                    if not section.startswith(NESTED))
+        _frame['total'] = frame
+        _frame['other'] = max(frame - timed, 0.0)
+
+        for section in _history.keys() - _frame.keys():
+            _history[section].append(0.0)
+        for section, ms in _frame.items():
+            samples = _history.get(section)
+            if samples is None:
+                samples = _history[section] = deque(maxlen=HISTORY)
+            samples.append(ms)
+
+        if recording:
+            _rows.append({section: round(ms, 3)
+                          for section, ms in _frame.items()})
+
+        _frames += 1
+        if _frames % REFRESH == 0 or not _lines:
+            _lines[:] = report()
+
+    _frame.clear()
+    _frame_start = now
+
+
+def percentile(samples, p):
+    ''' Nearest rank percentile of samples, already sorted. '''
+    if not samples:
+        return 0.0
+    rank = max(int(round(p / 100.0 * len(samples))) - 1, 0)
+    return samples[rank]
+
+
+def report():
+    ''' Overlay lines for every section, slowest p95 first. '''
+    rows = []
+    for section, samples in _history.items():
+        ordered = sorted(samples)
+        rows.append((section, samples[-1]) +
+                    tuple(percentile(ordered, p) for p in PERCENTILES))
+    rows.sort(key=lambda row: -row[3])
+
+    lines = [('ms', 'last') + tuple('p%d' % p for p in PERCENTILES)]
+    for row in rows[:MAX_LINES]:
+        lines.append((row[0],) + tuple('%.1f' % ms for ms in row[1:]))
+    return lines
+
+
+def render(x, y):
+    if not _lines:
+        return
+
+    # The font is proportional, so each column is laid out on its own
+    font = peachy.graphics.font()
+    line_height = font.get_sized_height()
+    columns = [x]
+    for column in zip(*_lines):
+        columns.append(columns[-1] + 6 +
+                       max(font.get_rect(cell).width for cell in column))
+
+    peachy.graphics.set_color(0, 0, 0, 160)
+    peachy.graphics.draw_rect(x - 2, y - 1, columns[-1] - x,
+                              line_height * len(_lines) + 2)
+    if recording:
+        peachy.graphics.set_color(255, 96, 96)
+    else:
+        peachy.graphics.set_color(255, 255, 255)
+    for line in _lines:
+        for column_x, cell in zip(columns, line):
+            text.draw(cell, column_x, y)
+        y += line_height
@@ -1,44 +1,70 @@
 import os
+import time
 
 import peachy
 from peachy import PC
 
 import game
-from game import config, entities
+from game import assets, config, entities, profiler, stage
 from game.entities import Player
-from game.utility import Camera, ParallaxBackground
+from game.utility import ActivityZone, Camera, ChunkedLayer, \
+    ParallaxBackground, RenderQueue, StaticCollisionIndex
 
 
 class OverYonderRoom(peachy.Room):
 
     ACTIVE_ZONE_SIZE = (384, 240)  # PC.view_size * 1.5
 
-    # If player moves at 2.5/s then they will pass the active zone in 25 cycles.
-    # Therefore the active zone must be updated every 24 cycles to prevent the
-    # player from interracting with an inactive entity.
-    ACTIVITY_UPDATE_WAIT_TIME = 24
+    # Groups kept active wherever they are
+    ALWAYS_ACTIVE = ('boulder', 'solid')
+
+    # Sprites may be drawn outside their entity's bounds (origins, effects),
+    # so render culling keeps entities this close to the view
+    RENDER_MARGIN = 32
 
     STATE_RUNNING = 0
     STATE_PAUSED = 1
     STATE_CHANGING_STAGES = 2
 
+    # Entities that never move after load, indexed once per stage
+    STATIC_SOLIDS = (entities.Solid, entities.BreakableTile, entities.Platform)
+
     def __init__(self):
         super().__init__(self)
 
         self.player = None
 
         self.stage_data = None
+        self.stage_path = ''  # as given to _load_stage, under assets/
+        self.stage_loader = stage.StageLoader()
+        self.stage_assets = ()  # acquired from game.assets for this stage
         self.previous_stage = ''
-        self.foreground_layers = []
-        self.background_layers = []
+        self.foreground_layers = []  # ChunkedLayer
+        self.background_layers = []  # ChunkedLayer
 
-        self.refresh_timer = OverYonderRoom.ACTIVITY_UPDATE_WAIT_TIME
+        self.activity_zone = ActivityZone(*OverYonderRoom.ACTIVE_ZONE_SIZE)
         self.running = True
 
         self.triggered_events = []
+        self.flags = []  # restored from saves and recordings
+
+        self.static_solids = StaticCollisionIndex()
+        self.dynamic_entities = {}  # insertion ordered set
+        self._awake_dynamic = (None, [])  # awake list, its dynamic entities
+
+        self.names = {}   # name -> {entity: None}, kept in insertion order
+        self.groups = {}  # group -> {entity: None}, kept in insertion order
+
+        # Entities destroyed mid-update leave the list once the loop is done
+        self.updating = False
+        self.pending_removals = {}
 
         self.camera = Camera(PC.width, PC.height)
         self.background = ParallaxBackground(PC.width, PC.height)
+        self.render_queue = RenderQueue()
+        # Drawn in the last frame, all the others (invisible included), and
+        # the flipped sprites the render queue reused
+        self.render_counts = (0, 0, 0)
 
         self.planet = {
             'name': '',
@@ -61,60 +87,243 @@ class OverYonderRoom(peachy.Room):
             except AttributeError:
                 pass  # sprite is not of SpriteMap
 
+    def add(self, entity):
+        if entity in self.dynamic_entities or entity in self.static_solids:
+            return entity
+
+        # Removed earlier this update and added back before the removal
+        # was carried out, it is still in the entity list
+        if entity in self.pending_removals:
+            del self.pending_removals[entity]
+        else:
+            entity = super().add(entity)
+        self.dynamic_entities[entity] = None
+        self.activity_zone.add(
+            entity, pinned=entity is self.player or
+            entity.group in OverYonderRoom.ALWAYS_ACTIVE)
+
+        if entity.name:
+            self.names.setdefault(entity.name, {})[entity] = None
+        for group in entity.group.split():
+            self.groups.setdefault(group, {})[entity] = None
+        return entity
+
     def change_stage(self, path):
         self.pause()
         PC.world.change_state(game.worlds.ROOM_TRANSITION_STATE, path)
 
     def clear(self):
         super().clear()
+        self.static_solids.clear()
+        self.dynamic_entities = {}
+        self._awake_dynamic = (None, [])
+        self.activity_zone.clear()
+        self.names = {}
+        self.groups = {}
         self.stage_data = None
+        for layer in self.background_layers + self.foreground_layers:
+            layer.free()
         self.background_layers = []
         self.foreground_layers = []
 
     def close(self):
         self.clear()
-        self.stage_data.clear()
+        assets.release(self.stage_assets)
+        self.stage_assets = ()
+        self.stage_loader.shutdown()
+
+    def collides_solid(self, entity, x=None, y=None):
+        ''' Solids overlapping entity at (x, y). Static stage geometry is
+        answered by the index, everything else by the awake dynamic
+        entities. '''
+        start = time.perf_counter() if profiler.enabled else None
+
+        if x is None or y is None:
+            x = entity.x
+            y = entity.y
+
+        collisions = []
+        for solid in self.static_solids.query(x, y,
+                                              entity.width, entity.height):
+            if solid.solid and solid.active and solid is not entity:
+                collisions.append(solid)
+
+        for other in self._awake_dynamic_entities():
+            if other.solid and other.active and other is not entity and \
+               entity.collides(other, x, y):
+                collisions.append(other)
+
+        if start is not None:
+            profiler.add('collision', time.perf_counter() - start)
+        return collisions
+
+    def get_group(self, group):
+        return list(self.groups.get(group, ()))
+
+    def get_name(self, name):
+        # The first entity added under name, as a scan of the room finds
+        named = self.names.get(name)
+        if named:
+            return next(iter(named))
+        return None
+
+    def mark_tiles_dirty(self, x, y, width, height):
+        ''' Call after changing stage tiles inside the rect so the cached
+        layer chunks are re-rendered '''
+        for layer in self.background_layers + self.foreground_layers:
+            layer.mark_dirty(x, y, width, height)
+
+    def remove(self, entity):
+        if self.updating:
+            self.pending_removals[entity] = None
+        else:
+            super().remove(entity)
+
+        if entity in self.static_solids:
+            self.static_solids.remove(entity)
+        else:
+            self.dynamic_entities.pop(entity, None)
+        self.activity_zone.remove(entity)
+
+        named = self.names.get(entity.name)
+        if named is not None:
+            named.pop(entity, None)
+            if not named:
+                del self.names[entity.name]
+        for group in entity.group.split():
+            members = self.groups.get(group)
+            if members is not None:
+                members.pop(entity, None)
+
+    def remove_group(self, group):
+        for entity in self.get_group(group):
+            self.remove(entity)
+
+    def remove_name(self, name):
+        entity = self.get_name(name)
+        if entity is not None:
+            self.remove(entity)
 
     def render(self):
         # Update camera location
         self.camera.update()
         self.camera.translate()
 
-        # Draw stage & entities
-        self.background.render(self.camera.x, self.camera.y)
-
-        for layer in self.background_layers:
-            peachy.stage.render_layer(self.stage_data, layer)
-        for entity in self.entities:
-            if entity.visible and entity != self.player:
+        # Draw stage & entities, one batch of blits per layer
+        view = (self.camera.x, self.camera.y, PC.width, PC.height)
+
+        profiling = profiler.enabled
+        if profiling:
+            start = time.perf_counter()
+
+        with self.render_queue as queue:
+            self.background.render(self.camera.x, self.camera.y)
+            queue.flush()
+            if profiling:
+                start = self._profile('render:background', start)
+
+            for layer in self.background_layers:
+                layer.render(*view)
+            queue.flush()
+            if profiling:
+                start = self._profile('render:tiles', start)
+
+            margin = OverYonderRoom.RENDER_MARGIN
+            left = self.camera.x - margin
+            top = self.camera.y - margin
+            right = self.camera.x + PC.width + margin
+            bottom = self.camera.y + PC.height + margin
+
+            # Only the statics near the view and the awake dynamic entities
+            # are looked at; the activity zone holds the view, so dormant
+            # entities are off screen
+            on_screen = [entity for entity in self.static_solids.query(
+                left, top, right - left, bottom - top) if entity.visible]
+            for entity in self._awake_dynamic_entities():
+                if entity.visible and entity is not self.player and \
+                   not (entity.x + entity.width < left or entity.x > right or
+                        entity.y + entity.height < top or entity.y > bottom):
+                    on_screen.append(entity)
+
+            # Drawn in the order they were added, as the entity list is
+            order = self.activity_zone.order
+            on_screen.sort(key=lambda entity: order.get(entity, 0))
+            for entity in on_screen:
                 entity.render()
-        self.player.render()
-        for layer in self.foreground_layers:
-            peachy.stage.render_layer(self.stage_data, layer)
+
+            self.player.render()
+            queue.flush()
+            if profiling:
+                start = self._profile('render:entities', start)
+
+            drawn = len(on_screen) + 1
+
+            for layer in self.foreground_layers:
+                layer.render(*view)
+
+        self.render_counts = (drawn, len(self.entities) - drawn,
+                              queue.flip_hits)
+
+        if profiling:
+            self._profile('render:tiles', start)
 
     def update(self):
         if self.running:
-            # Update activity zone
-            self.refresh_timer -= 1
-            if self.refresh_timer <= 0:
-                self.refresh_timer = OverYonderRoom.ACTIVITY_UPDATE_WAIT_TIME
-                self._update_activity_zone()
+            self.updating = True
+
+            self._update_activity_zone()
 
             # Update entities
             if peachy.utils.Key.pressed(config.KEY['INTERACT']):
                 door = self.player.collides_group('door')
                 if door:
+                    self._flush_removals()
                     self.change_stage(door[0].link)
                     return
 
-            for entity in self.entities:
+            # Dormant entities are left out of the loop entirely
+            zone = self.activity_zone
+            profiling = profiler.enabled
+            for entity in zone.awake_entities():
                 # TODO add END_UPDATE event
                 if entity.active:
-                    entity.update()
+                    if profiling:
+                        start = time.perf_counter()
+                        entity.update()
+                        self._profile('update:' + type(entity).__name__,
+                                      start)
+                    else:
+                        entity.update()
+                    if not zone.update(entity) and \
+                       entity.group == 'projectile':
+                        entity.destroy()
+
+            self._flush_removals()
+
+    def _build_static_index(self):
+        static = [entity for entity in self.entities
+                  if isinstance(entity, OverYonderRoom.STATIC_SOLIDS)]
+        self.static_solids.build(static)
+        self.dynamic_entities = {entity: None for entity in self.entities
+                                 if entity not in self.static_solids}
+        self._awake_dynamic = (None, [])
+
+    def _awake_dynamic_entities(self):
+        awake = self.activity_zone.awake_entities()
+        if self._awake_dynamic[0] is not awake:
+            self._awake_dynamic = (awake, [entity for entity in awake
+                                           if entity in self.dynamic_entities])
+        return self._awake_dynamic[1]
+
+    def _flush_removals(self):
+        self.updating = False
+        for entity in self.pending_removals:
+            super().remove(entity)
+        self.pending_removals = {}
 
     def _change_background(self):
         self.background.clear()
-        get_image = peachy.fs.get_image
+        get_image = assets.get_image
 
         if self.planet['name'] == 'OBERON':
             if self.planet['outside']:
@@ -131,6 +340,13 @@ class OverYonderRoom(peachy.Room):
             self.background.add_layer(get_image('BACKGROUND_REPTILIA_FAR'),
                                       0.25, 0, True)
 
+    def _profile(self, section, start):
+        ''' Time since start goes to section. Returns the current time, to
+        start the next section from. '''
+        now = time.perf_counter()
+        profiler.add(section, now - start)
+        return now
+
     def _update_activity_zone(self):
         arw, arh = OverYonderRoom.ACTIVE_ZONE_SIZE
         arx = (self.player.x + Player.WIDTH / 2) - arw / 2
@@ -145,16 +361,56 @@ class OverYonderRoom(peachy.Room):
         elif ary > self.stage_data.height - arh:
             ary = self.stage_data.height - arh
 
-        active_zone = (arx, ary, arw, arh)
-
-        for entity in self.entities:
-            if entity.collides_rect(active_zone) or \
-               entity.group == 'boulder' or entity.group == 'solid':
-                entity.active = True
-            elif entity.group == 'projectile':
+        for entity in self.activity_zone.move(arx, ary):
+            if entity.group == 'projectile':
                 entity.destroy()
-            else:
-                entity.active = False
+
+    def _object_factories(self, previous_stage, debug_spawn, spawn,
+                          linked_stages):
+        ''' OBJECT_FACTORIES plus the objects that place the player or link
+        to other stages. Fills in spawn and linked_stages as they are built '''
+        factories = dict(entities.OBJECT_FACTORIES)
+        create_door = factories['DOOR']
+        create_item = factories['ITEM']
+        create_save_point = factories['SAVE_POINT']
+        create_ship = factories['SHIP']
+
+        def door(OBJ):
+            link = OBJ.properties['LINK']
+            linked_stages.append(link)
+            if os.path.basename(link)[:-4] == previous_stage:
+                spawn['x'] = OBJ.x + 3
+                spawn['y'] = OBJ.y + 4
+            return create_door(OBJ)
+
+        def item(OBJ):
+            if OBJ.properties['GLOBAL_ID'] not in self.player.items:
+                return create_item(OBJ)
+
+        def save_point(OBJ):
+            if not spawn.get('x') and not spawn.get('y'):
+                spawn['x'] = OBJ.x
+                spawn['y'] = OBJ.y
+            return create_save_point(OBJ)
+
+        def ship(OBJ):
+            if previous_stage == 'stage/oberon_landing_site.tmx' or \
+               previous_stage == 'stage/reptilia.tmx':
+                spawn['x'] = OBJ.x
+                spawn['y'] = OBJ.y
+            return create_ship(OBJ)
+
+        def debug_spawn_point(OBJ):
+            if debug_spawn:
+                spawn['x'] = OBJ.x
+                spawn['y'] = OBJ.y
+
+        factories['DOOR'] = door
+        factories['ITEM'] = item
+        factories['SAVE_POINT'] = save_point
+        factories['SHIP'] = ship
+        factories['DEBUG_SPAWN'] = debug_spawn_point
+        return factories
 
     def _load_stage(self, path, debug_spawn=False):
         if PC.debug:
@@ -164,8 +420,11 @@ class OverYonderRoom(peachy.Room):
         previous_stage = ''
         if self.stage_data:
             previous_stage = self.stage_data.name
-        stage_data = peachy.stage.load_tiled_tmx('assets/' + path)
-        stage_data.name = os.path.basename(stage_data.path)[:-4]
+        # Stage data may be shared with the loader's cache, treat it as
+        # read-only and keep per-visit state on the room
+        stage_data = self.stage_loader.get(path)
+        if PC.debug:
+            print('[LOG] stage cache: ' + self.stage_loader.cache.stats())
 
         if 'PLANET' in stage_data.properties:
             self.planet['name'] = stage_data.properties['PLANET'].upper()
@@ -178,6 +437,17 @@ class OverYonderRoom(peachy.Room):
         else:
             self.planet['outside'] = False
 
+        # Take this stage's backgrounds and tilesets before letting go of the
+        # last stage's, so the assets they share stay loaded
+        stage_assets = assets.group(self.planet['name']) + \
+            stage.stage_tilesets(stage_data)
+        assets.acquire(stage_assets)
+        assets.release(self.stage_assets)
+        self.stage_assets = stage_assets
+        if self.stage_data is not None and self.stage_data is not stage_data:
+            # Its tiles would keep the tilesets just released alive
+            stage.release_tiles(self.stage_data)
+
         # Reset
         self.clear()
 
@@ -185,171 +455,38 @@ class OverYonderRoom(peachy.Room):
         for layer in stage_data.layers:
             name = layer.name[:10]
             if name == 'BACKGROUND':
-                self.background_layers.append(layer)
+                self.background_layers.append(ChunkedLayer(stage_data, layer))
             if name == 'FOREGROUND':
-                self.foreground_layers.append(layer)
+                self.foreground_layers.append(ChunkedLayer(stage_data, layer))
 
         # Parse objects
-        player_spawn_x = None
-        player_spawn_y = None
+        spawn = {}
+        linked_stages = []
+        factories = self._object_factories(previous_stage, debug_spawn,
+                                           spawn, linked_stages)
+        profile = {} if PC.debug else None
 
         for OBJ in stage_data.objects:
 
             if OBJ.group == 'SOLIDS':
-
-                flip_x = False
-                flip_y = False
-
-                if OBJ.is_polygon:
-                    x = OBJ.x
-                    y = OBJ.y
-                    w = 0
-                    h = 0
-                    flip_x = True
-
-                    for point in OBJ.polygon_points:
-                        if point.x != 0:
-                            if w != 0:
-                                flip_x = False
-                            w = abs(point.x)
-                        if point.y != 0:
-                            h = abs(point.y)
-                            if point.y < 0:
-                                y -= h
-
-                    self.add(entities.Solid(x, y, w, h, True, flip_x, flip_y))
-                else:
-                    self.add(entities.Solid(OBJ.x, OBJ.y, OBJ.w, OBJ.h))
+                self.add(entities.Solid.from_stage_object(OBJ))
 
             elif OBJ.group == 'OBJECTS':
 
-                obj = None
-
-                if OBJ.name == 'ARROW_TRAP':
-                    direction = OBJ.properties['DIRECTION']
-                    obj = entities.ArrowTrap(OBJ.x, OBJ.y, direction)
-
-                elif OBJ.name == 'BAT':
-                    obj = entities.Bat(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'BOULDER_SPAWNER':
-                    spawn_direction = OBJ.properties['DIRECTION']
-                    obj = entities.BoulderSpawner(OBJ.x, OBJ.y, spawn_direction)
-
-                elif OBJ.name == 'BREAKABLE':
-                    obj = entities.BreakableTile(OBJ.x, OBJ.y)
+                factory = factories.get(OBJ.name)
+                if factory is None:
+                    if PC.debug:
+                        print('[WARNING] unknown stage object: ' + OBJ.name)
+                    continue
 
-                elif OBJ.name == 'BREAKABLE_REINFORCED':
-                    obj = entities.BreakableReinforcedTile(OBJ.x, OBJ.y,
-                                                           OBJ.w, OBJ.h)
-
-                elif OBJ.name == 'CLIMB':
-                    obj = entities.AbsClimbable(OBJ.x, OBJ.y, OBJ.h)
-
-                elif OBJ.name == 'DASHER':
-                    initial_direction = OBJ.properties['DIRECTION']
-                    obj = entities.Dasher(OBJ.x, OBJ.y, initial_direction)
-
-                elif OBJ.name == 'DOOR':
-                    link = OBJ.properties['LINK']
-
-                    obj = entities.Door(OBJ.x, OBJ.y, link)
-
-                    link = os.path.basename(link)[:-4]
-                    if link == previous_stage:
-                        player_spawn_x = OBJ.x + 3
-                        player_spawn_y = OBJ.y + 4
-
-                elif OBJ.name == 'GOBLIN_IMP':
-                    obj = entities.GoblinImp(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'GOBLIN_SWORDSMAN':
-                    obj = entities.GoblinSwordsman(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'ITEM':
-                    global_id = OBJ.properties['GLOBAL_ID']
-                    item_type = OBJ.properties['ITEM_TYPE']
-                    value = OBJ.properties['VALUE']
-
-                    if global_id not in self.player.items:
-                        obj = entities.Item(OBJ.x, OBJ.y,
-                                            global_id, item_type, value)
-
-                elif OBJ.name == 'MOVING_PLATFORM':
-                    start_x = OBJ.x
-                    start_y = OBJ.y
-                    end_x = OBJ.x + OBJ.polygon_points[1].x
-                    end_y = OBJ.y + OBJ.polygon_points[1].y
-
-                    obj = entities.MovingPlatform(start_x, start_y,
-                                                  end_x, end_y)
-
-                elif OBJ.name == 'PLATFORM':
-                    obj = entities.Platform(OBJ.x, OBJ.y, OBJ.w)
-
-                elif OBJ.name == 'PRESSURE_PLATE':
-                    on_activate = OBJ.properties['ON_ACTIVATE']
-                    on_deactive = OBJ.properties['ON_DEACTIVATE']
-                    obj = entities.PressurePlate(OBJ.x, OBJ.y + 12,
-                                                 on_activate,
-                                                 on_deactive)
-
-                elif OBJ.name == 'RESOURCE_SLUG_HIVE':
-                    orientation = OBJ.properties['ORIENTATION']
-                    slug_direction = OBJ.properties['DIRECTION']
-                    obj = entities.ResourceSlugHive(OBJ.x, OBJ.y,
-                                                    orientation,
-                                                    slug_direction)
-
-                elif OBJ.name == 'RETRACTABLE_DOOR':
-                    obj = entities.RetractableDoor(OBJ.x, OBJ.y,
-                                                   OBJ.w, OBJ.h)
-
-                elif OBJ.name == 'SAVE_POINT':
-                    obj = entities.SaveStation(OBJ.x, OBJ.y)
-
-                    if not player_spawn_x and not player_spawn_y:
-                        player_spawn_x = OBJ.x
-                        player_spawn_y = OBJ.y
-
-                elif OBJ.name == 'SHIP':
-                    obj = entities.Ship(OBJ.x, OBJ.y)
-
-                    if previous_stage == 'stage/oberon_landing_site.tmx' or \
-                       previous_stage == 'stage/reptilia.tmx':
-                        player_spawn_x = OBJ.x
-                        player_spawn_y = OBJ.y
-
-                elif OBJ.name == 'SIGN':
-                    message = OBJ.properties['MESSAGE']
-                    obj = entities.SignPost(OBJ.x, OBJ.y, message)
-
-                elif OBJ.name == 'SPIDER':
-                    obj = entities.Spider(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'SPIKES':
-                    obj = entities.Spikes(OBJ.x, OBJ.y, OBJ.w)
-
-                elif OBJ.name == 'SMALL_GOLEM':
-                    obj = entities.SmallGolem(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'SKELETON':
-                    obj = entities.Skeleton(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'SWITCH':
-                    on_activate = OBJ.properties['ON_ACTIVATE']
-                    obj = entities.Switch(OBJ.x, OBJ.y, on_activate)
-
-                elif OBJ.name == 'WATER':
-                    obj = entities.Water(OBJ.x, OBJ.y, OBJ.w, OBJ.h)
-
-                elif OBJ.name == 'WEIGHT':
-                    obj = entities.Weight(OBJ.x, OBJ.y)
-
-                elif OBJ.name == 'DEBUG_SPAWN':
-                    if debug_spawn:
-                        player_spawn_x = OBJ.x
-                        player_spawn_y = OBJ.y
+                if profile is None:
+                    obj = factory(OBJ)
+                else:
+                    start = time.perf_counter()
+                    obj = factory(OBJ)
+                    elapsed = time.perf_counter() - start
+                    count, total = profile.get(OBJ.name, (0, 0))
+                    profile[OBJ.name] = (count + 1, total + elapsed)
 
                 if obj is not None:
                     if 'NAME' in OBJ.properties:
@@ -358,18 +495,25 @@ class OverYonderRoom(peachy.Room):
                         obj.active = bool(OBJ.properties['ACTIVE'])
                     self.add(obj)
 
+        if profile:
+            for name, (count, total) in sorted(profile.items(),
+                                               key=lambda item: -item[1][1]):
+                print('[LOG] %s x%d: %.3f ms' % (name, count, total * 1000))
+
         # TODO load player like regular entity
         if self.player is None:
             self.player = entities.Player(0, 0)
 
-        if player_spawn_x is not None and player_spawn_y is not None:
-            self.player.x = player_spawn_x
-            self.player.y = player_spawn_y
+        if spawn:
+            self.player.x = spawn['x']
+            self.player.y = spawn['y']
         self.add(self.player)
 
-        if self.stage_data is not None:
-            self.stage_data.clear()
+        self._build_static_index()
+
+        # Previous stage data stays with the loader's cache
         self.stage_data = stage_data
+        self.stage_path = path
 
         self.camera.max_width = self.stage_data.width
         self.camera.max_height = self.stage_data.height
@@ -379,3 +523,10 @@ class OverYonderRoom(peachy.Room):
 
         self._change_background()
         self._update_activity_zone()
+
+        if PC.debug:
+            print('[LOG] assets: ' + assets.stats())
+
+        # Parse the stages behind this room's doors while it is being played
+        for link in linked_stages:
+            self.stage_loader.preload(link)
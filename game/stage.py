@@ -0,0 +1,573 @@
+import array
+import copy
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+import peachy
+
+from game import assets, config
+
+# Compiled stage layout (native byte order, recorded in the header):
+#   header | pickled metadata table | layer gid grids, 4-byte aligned
+# The metadata holds map size, properties, tilesets, layer offsets and every
+# object pre-parsed into tuples. Gid grids are raw array('H') (or array('I')
+# when a gid carries Tiled's flip bits) and are read straight out of the mmap.
+COMPILED_EXTENSION = '.tmxc'
+COMPILED_MAGIC = b'OYST'
+COMPILED_VERSION = 1
+
+_HEADER = struct.Struct('<4sHBdQI')  # magic, version, little endian,
+                                     # source mtime, source size, meta length
+
+
+def compiled_path(tmx_path):
+    return os.path.splitext(tmx_path)[0] + COMPILED_EXTENSION
+
+
+def compile_stage(tmx_path, output_path=None):
+    ''' Parse a Tiled TMX file once and write it out in compiled form '''
+    if output_path is None:
+        output_path = compiled_path(tmx_path)
+
+    root = ElementTree.parse(tmx_path).getroot()
+    tile_width = int(root.get('tilewidth'))
+    tile_height = int(root.get('tileheight'))
+
+    meta = {
+        'columns': int(root.get('width')),
+        'rows': int(root.get('height')),
+        'tile_width': tile_width,
+        'tile_height': tile_height,
+        'properties': _parse_properties(root),
+        'tilesets': [],
+        'layers': [],
+        'objects': []
+    }
+
+    for tileset in root.findall('tileset'):
+        image = tileset.find('image')
+        meta['tilesets'].append((
+            tileset.get('name'),
+            int(tileset.get('firstgid')),
+            int(tileset.get('tilewidth', tile_width)),
+            int(tileset.get('tileheight', tile_height)),
+            image.get('source') if image is not None else '',
+            image.get('trans', '') if image is not None else ''))
+
+    grids = []
+    for layer in root.findall('layer'):
+        gids = [int(tile.get('gid', 0))
+                for tile in layer.find('data').findall('tile')]
+        typecode = 'H' if max(gids or [0]) <= 0xFFFF else 'I'
+        grids.append((layer.get('name'), typecode, array.array(typecode, gids)))
+
+    for group in root.findall('objectgroup'):
+        for obj in group.findall('object'):
+            points = None
+            shape = obj.find('polygon')
+            if shape is None:
+                shape = obj.find('polyline')
+            if shape is not None:
+                points = [tuple(_number(v) for v in point.split(','))
+                          for point in shape.get('points').split()]
+
+            meta['objects'].append((
+                group.get('name'),
+                obj.get('name', ''),
+                _number(obj.get('x', '0')),
+                _number(obj.get('y', '0')),
+                _number(obj.get('width', '0')),
+                _number(obj.get('height', '0')),
+                points,
+                _parse_properties(obj)))
+
+    # Lay out the gid grids after the metadata, which records their offsets
+    offset = 0
+    for name, typecode, grid in grids:
+        meta['layers'].append((name, typecode, offset, len(grid)))
+        offset += _aligned(len(grid) * grid.itemsize)
+
+    meta_blob = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+    data_start = _aligned(_HEADER.size + len(meta_blob))
+
+    stat = os.stat(tmx_path)
+    with open(output_path, 'wb') as compiled:
+        compiled.write(_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION,
+                                    sys.byteorder == 'little',
+                                    stat.st_mtime, stat.st_size,
+                                    len(meta_blob)))
+        compiled.write(meta_blob)
+        compiled.write(b'\0' * (data_start - compiled.tell()))
+        for _, _, grid in grids:
+            data = grid.tobytes()
+            compiled.write(data)
+            compiled.write(b'\0' * (_aligned(len(data)) - len(data)))
+
+    return output_path
+
+
+def load_compiled(tmx_path):
+    ''' Load the compiled form of tmx_path, or None if it is missing or out of
+    date with its source '''
+    path = compiled_path(tmx_path)
+    try:
+        stat = os.stat(tmx_path)
+        with open(path, 'rb') as compiled:
+            data = mmap.mmap(compiled.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if len(data) < _HEADER.size:
+        data.close()
+        return None
+
+    magic, version, little_endian, mtime, size, meta_length = \
+        _HEADER.unpack_from(data, 0)
+
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION or \
+       little_endian != (sys.byteorder == 'little') or \
+       mtime != stat.st_mtime or size != stat.st_size:
+        data.close()
+        return None
+
+    meta = pickle.loads(data[_HEADER.size:_HEADER.size + meta_length])
+    data_start = _aligned(_HEADER.size + meta_length)
+    return CompiledStage(tmx_path, meta, data, data_start)
+
+
+def load_stage(path):
+    ''' Load assets/<path>, preferring an up to date compiled stage '''
+    stage_data = load_compiled_stage(path)
+    if stage_data is None:
+        if peachy.PC.debug:
+            print('[LOG] compiled stage missing or stale: ' + path)
+        stage_data = peachy.stage.load_tiled_tmx(config.ASSET_PATH + path)
+        stage_data.name = os.path.splitext(os.path.basename(path))[0]
+    return stage_data
+
+
+def load_compiled_stage(path):
+    ''' Load the compiled form of assets/<path>, or None. Unlike parsing a
+    TMX, this touches no pygame surfaces, so it is safe off the main
+    thread '''
+    stage_data = load_compiled(config.ASSET_PATH + path)
+    if stage_data is not None:
+        stage_data.name = os.path.splitext(os.path.basename(path))[0]
+    return stage_data
+
+
+def close_stage(stage_data):
+    ''' Free what stage_data holds open, once nothing draws from it '''
+    if isinstance(stage_data, CompiledStage):
+        stage_data.clear()
+
+
+def render_layer(stage_data, layer):
+    if isinstance(stage_data, CompiledStage):
+        stage_data.render_layer(layer)
+    else:
+        peachy.stage.render_layer(stage_data, layer)
+
+
+def layer_chunks(stage_data, layer, size):
+    ''' layer cut into square chunks size pixels wide, as {(column, row):
+    part} over the chunks holding at least one tile. Each part is a layer
+    render_layer draws, holding only the tiles that reach into its chunk. '''
+    tile_width = stage_data.tile_width
+    tile_height = stage_data.tile_height
+
+    if isinstance(stage_data, CompiledStage):
+        columns = layer.columns
+        cells = ((i % columns, i // columns)
+                 for i, gid in enumerate(layer.gids) if gid)
+        tile_sizes = [tileset[2:4] for tileset in stage_data.tilesets]
+    else:
+        cells = ((tile.x, tile.y) for tile in layer.tiles if tile.gid)
+        tile_sizes = [(tileset.tilewidth, tileset.tileheight)
+                      for tileset in stage_data.tilesets]
+
+    # Tiles from tilesets with larger tiles reach past their cell
+    reach_x = max([tile_width] + [width for width, _ in tile_sizes])
+    reach_y = max([tile_height] + [height for _, height in tile_sizes])
+
+    chunks = {}  # (column, row) -> [cell]
+    for cell_x, cell_y in cells:
+        x = cell_x * tile_width
+        y = cell_y * tile_height
+        for column in range(x // size, (x + reach_x - 1) // size + 1):
+            for row in range(y // size, (y + reach_y - 1) // size + 1):
+                chunks.setdefault((column, row), []).append((cell_x, cell_y))
+
+    if isinstance(stage_data, CompiledStage):
+        return {(column, row): CompiledStage.Layer(
+                    layer.name, layer.gids, layer.columns,
+                    (column * size, row * size, size, size))
+                for column, row in chunks}
+
+    parts = {}
+    tiles = {}  # cell -> tile
+    for tile in layer.tiles:
+        tiles[(tile.x, tile.y)] = tile
+    for chunk, chunk_cells in chunks.items():
+        part = copy.copy(layer)
+        part.tiles = [tiles[cell] for cell in chunk_cells]
+        parts[chunk] = part
+    return parts
+
+
+def stage_size(stage_data):
+    ''' Rough memory footprint of stage_data in bytes, used to bound the
+    StageCache '''
+    if isinstance(stage_data, CompiledStage):
+        return stage_data.size
+    try:
+        # A parsed TMX holds every tile and object as a Python object, which
+        # comes to a few times its source size
+        return os.path.getsize(stage_data.path) * 4
+    except (AttributeError, OSError):
+        return 0
+
+
+def stage_tilesets(stage_data):
+    ''' Asset names of the tileset images stage_data draws from. Only
+    compiled stages load their tilesets through game.assets '''
+    if isinstance(stage_data, CompiledStage):
+        return tuple(assets.image_name(stage_data.tileset_path(tileset[4]))
+                     for tileset in stage_data.tilesets if tileset[4])
+    return ()
+
+
+def release_tiles(stage_data):
+    ''' Drop the tiles stage_data has cut from its tilesets, so releasing
+    the tilesets through game.assets frees them. They are cut again if the
+    stage is drawn later. '''
+    if isinstance(stage_data, CompiledStage):
+        stage_data.release_tiles()
+
+
+def _aligned(length):
+    return (length + 3) & ~3
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _parse_properties(element):
+    properties = {}
+    container = element.find('properties')
+    if container is not None:
+        for prop in container.findall('property'):
+            value = prop.get('value')
+            if value is None:
+                value = prop.text or ''
+            properties[prop.get('name')] = value
+    return properties
+
+
+class CompiledStage(object):
+    ''' Stage data read from a compiled stage. Exposes the same attributes
+    OverYonderRoom reads from a parsed TMX. Stages are shared through the
+    StageCache, so layers, objects and properties are read-only. '''
+
+    def __init__(self, path, meta, data, data_start):
+        self.path = path
+        self.name = ''
+
+        self.tile_width = meta['tile_width']
+        self.tile_height = meta['tile_height']
+        self.columns = meta['columns']
+        self.rows = meta['rows']
+        self.width = self.columns * self.tile_width
+        self.height = self.rows * self.tile_height
+
+        self.properties = MappingProxyType(meta['properties'])
+        self.tilesets = tuple(meta['tilesets'])
+
+        self._data = data
+        self._view = memoryview(data)
+        self.size = len(data) + len(meta['objects']) * 512
+
+        layers = []
+        for name, typecode, offset, count in meta['layers']:
+            start = data_start + offset
+            end = start + count * array.array(typecode).itemsize
+            gids = self._view[start:end].cast(typecode)
+            layers.append(CompiledStage.Layer(name, gids, self.columns))
+        self.layers = tuple(layers)
+
+        self.objects = tuple(CompiledStage.Object(*obj)
+                             for obj in meta['objects'])
+
+        self._tile_images = None
+
+    def clear(self):
+        # Every view into the mmap must be released before it can close
+        for layer in self.layers:
+            layer.gids.release()
+        self._view.release()
+        self.layers = ()
+        self.objects = ()
+        self.release_tiles()
+        self._data.close()
+
+    def release_tiles(self):
+        self._tile_images = None
+
+    def render_layer(self, layer):
+        if self._tile_images is None:
+            self._load_tile_images()
+
+        tile_images = self._tile_images
+        tile_width = self.tile_width
+        tile_height = self.tile_height
+        columns = layer.columns
+        gids = layer.gids
+
+        first_column = first_row = 0
+        last_column = columns
+        last_row = len(gids) // columns if columns else 0
+        if layer.area is not None:
+            # Tiles from tilesets with larger tiles reach past their cell
+            overhang_x = max([0] + [tileset[2] - tile_width
+                                    for tileset in self.tilesets])
+            overhang_y = max([0] + [tileset[3] - tile_height
+                                    for tileset in self.tilesets])
+            x, y, width, height = layer.area
+            x -= overhang_x
+            y -= overhang_y
+            width += overhang_x
+            height += overhang_y
+            first_column = max(first_column, x // tile_width)
+            first_row = max(first_row, y // tile_height)
+            last_column = min(last_column, -(-(x + width) // tile_width))
+            last_row = min(last_row, -(-(y + height) // tile_height))
+
+        for row in range(first_row, last_row):
+            start = row * columns
+            for column in range(first_column, last_column):
+                gid = gids[start + column]
+                if gid:
+                    image = tile_images.get(gid)
+                    if image is not None:
+                        peachy.graphics.draw(image, column * tile_width,
+                                             row * tile_height)
+
+    def tileset_path(self, source):
+        ''' Path of a tileset image, given relative to the stage '''
+        return os.path.normpath(os.path.join(os.path.dirname(self.path),
+                                             source))
+
+    def _load_tile_images(self):
+        self._tile_images = {}
+
+        for name, firstgid, width, height, source, trans in self.tilesets:
+            if not source:
+                continue
+            colorkey = None
+            if trans:
+                colorkey = tuple(int(trans.lstrip('#')[i:i + 2], 16)
+                                 for i in (0, 2, 4))
+            image = assets.load_image(self.tileset_path(source), colorkey)
+            for i, tile in enumerate(peachy.graphics.splice(image,
+                                                            width, height)):
+                self._tile_images[firstgid + i] = tile
+
+    class Layer(object):
+        ''' With area, an (x, y, width, height) rect in pixels, only the
+        tiles reaching into it are drawn '''
+
+        def __init__(self, name, gids, columns, area=None):
+            self.name = name
+            self.gids = gids
+            self.columns = columns
+            self.area = area
+
+        def __repr__(self):
+            return '<Compiled Layer> ' + self.name
+
+    class Object(object):
+        def __init__(self, group, name, x, y, w, h, points, properties):
+            self.group = group
+            self.name = name
+            self.x = x
+            self.y = y
+            self.w = w
+            self.h = h
+            self.properties = MappingProxyType(properties)
+
+            self.is_polygon = points is not None
+            self.polygon_points = ()
+            if points is not None:
+                self.polygon_points = tuple(CompiledStage.Point(px, py)
+                                            for px, py in points)
+
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+
+
+class StageCache(object):
+    ''' Least recently used stage data, keyed by stage path and bounded by
+    the estimated size of the stages it holds. The most recent stage and the
+    current one, which the room is playing, are always kept. Evicted stages
+    are closed. '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # path -> (stage_data, size)
+        self.current = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return entry[0]
+
+    def acquire(self, path, stage_data=None):
+        ''' The cached stage for path, made the current one. If it is not
+        cached, stage_data is put in its place, or None returned when there
+        is none. Done under one lock, so it cannot be evicted in between. '''
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(path)
+            elif stage_data is None:
+                self.misses += 1
+                return None
+            self.current = path
+            return self._insert(path, stage_data)
+
+    def put(self, path, stage_data):
+        with self.lock:
+            self._insert(path, stage_data)
+
+    def _insert(self, path, stage_data):
+        # A stage already cached for path is kept, as the room may be using
+        # it, and the newcomer closed. Called with the lock held.
+        entry = self.entries.get(path)
+        if entry is not None:
+            if stage_data is not None and stage_data is not entry[0]:
+                close_stage(stage_data)
+            return entry[0]
+
+        size = stage_size(stage_data)
+        self.entries[path] = (stage_data, size)
+        self.size += size
+
+        for evicted_path in list(self.entries)[:-1]:
+            if self.size <= self.max_bytes:
+                break
+            if evicted_path == self.current:
+                continue
+            evicted, evicted_size = self.entries.pop(evicted_path)
+            self.size -= evicted_size
+            close_stage(evicted)
+        return stage_data
+
+    def clear(self):
+        with self.lock:
+            for stage_data, _ in self.entries.values():
+                close_stage(stage_data)
+            self.entries.clear()
+            self.current = None
+            self.size = 0
+
+    def stats(self):
+        return '%d hits, %d misses, %d stages, %d/%d KB' % \
+            (self.hits, self.misses, len(self.entries),
+             self.size // 1024, self.max_bytes // 1024)
+
+
+class StageLoader(object):
+    ''' Serves stage data from a StageCache, loading compiled stages linked
+    from the current room on a background thread so door transitions rarely
+    wait. Stages without an up to date compiled form are parsed by get(), on
+    the main thread, as parsing a TMX converts its tileset images. '''
+
+    def __init__(self, max_bytes=config.STAGE_CACHE_SIZE, workers=1):
+        self.cache = StageCache(max_bytes)
+        self.workers = workers
+        self.executor = None  # started by the first preload
+        self.pending = {}  # path -> Future
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        ''' Stage data for path, waiting on its preload if one is running.
+        The stage becomes the cache's current one. '''
+        stage_data = self.cache.acquire(path)
+        if stage_data is None:
+            with self.lock:
+                future = self.pending.pop(path, None)
+
+            if future is not None and future.exception() is None:
+                stage_data = future.result()
+            if stage_data is None:
+                stage_data = load_stage(path)
+            stage_data = self.cache.acquire(path, stage_data)
+        return stage_data
+
+    def preload(self, path):
+        with self.lock:
+            if path in self.pending or path in self.cache:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            future = self.executor.submit(load_compiled_stage, path)
+            self.pending[path] = future
+        future.add_done_callback(lambda f: self._loaded(path, f))
+
+    def shutdown(self):
+        ''' Stop preloading and close every cached stage. The loader can
+        still be used, and starts a new worker on its next preload. '''
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+            pending = list(self.pending.values())
+            self.pending.clear()
+
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for future in pending:
+            if not future.cancelled() and future.exception() is None:
+                if future.result() is not None:
+                    close_stage(future.result())
+        self.cache.clear()
+
+    def _loaded(self, path, future):
+        with self.lock:
+            if self.pending.get(path) is not future:
+                return  # Already claimed by get() or shutdown()
+            del self.pending[path]
+
+        # A failed or uncompiled preload is loaded (and reported) by get()
+        if future.exception() is None and future.result() is not None:
+            self.cache.put(path, future.result())
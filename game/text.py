@@ -0,0 +1,38 @@
+''' Cached text drawing. peachy.graphics.draw_text renders its string with
+the font on every call, and menus, HUD readouts and the profiler overlay
+draw the same strings every frame. draw() renders each (font, colour,
+string) once, keeps the surface in an LRU of CACHE_SIZE strings, and blits
+it with peachy.graphics.draw, so it is queued like any other image while a
+RenderQueue is open. '''
+from collections import OrderedDict
+
+import peachy
+
+from game.utility import graphics_color
+
+CACHE_SIZE = 256
+
+_cache = OrderedDict()  # (font, colour, text) -> Surface, oldest first
+
+
+def draw(text, x, y, font=None):
+    peachy.graphics.draw(render(text, font), x, y)
+
+
+def render(text, font=None):
+    ''' text as a Surface in the current colour '''
+    if font is None:
+        font = peachy.graphics.font()
+    color = graphics_color()
+
+    key = (font, tuple(color), text)
+    surface = _cache.get(key)
+    if surface is not None:
+        _cache.move_to_end(key)
+        return surface
+
+    surface, _ = font.render(text, color)
+    _cache[key] = surface
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return surface
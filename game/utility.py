@@ -1,10 +1,12 @@
 import math
 import peachy
+import pygame
 from peachy import PC
 
-from game import config
+from game import config, stage
 import heapq
 import pickle
+import weakref
 
 
 def a_star_search(grid, start, goal):
@@ -72,6 +74,216 @@ def load(file_name):
     return saved_data
 
 
+def wrap_text(text, width, font=None):
+    ''' Split text into lines no wider than width, breaking between words '''
+    if font is None:
+        font = peachy.graphics.font()
+
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            candidate = line + ' ' + word if line else word
+            if line and font.get_rect(candidate).width > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+# peachy.graphics has no accessors for its current target, translation or
+# colour, and no hook for batching its draws. The game reads its private
+# state and swaps its functions only through these four, so a change to
+# peachy's internals has one place to be fixed.
+
+def graphics_color():
+    ''' The colour peachy.graphics draws with '''
+    return peachy.graphics._color
+
+
+def graphics_target():
+    ''' (context, translate_x, translate_y) peachy.graphics draws to '''
+    translation = peachy.graphics._translation
+    return peachy.graphics._context, translation.x, translation.y
+
+
+def patch_graphics(replacements):
+    ''' Swap peachy.graphics functions for replacements, name -> function.
+    Returns the originals, to be put back with restore_graphics '''
+    originals = {}
+    try:
+        for name, function in replacements.items():
+            originals[name] = getattr(peachy.graphics, name)
+            setattr(peachy.graphics, name, function)
+    except Exception:
+        restore_graphics(originals)
+        raise
+    return originals
+
+
+def restore_graphics(originals):
+    for name, function in originals.items():
+        setattr(peachy.graphics, name, function)
+
+
+class ActivityZone(object):
+    ''' Keeps entities active while they are in a grid cell overlapping the
+    zone around the player. Entities are bucketed by the cell holding their
+    center, so work is only done when the zone or an entity crosses a cell
+    boundary.
+
+    The active entities, plus pinned ones the zone never puts to sleep, are
+    kept apart from the dormant so update loops only visit them. '''
+
+    CELL_SIZE = 64
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.cells = {}         # (column, row) -> {entity: None}
+        self.entity_cells = {}  # entity -> (column, row)
+        self.bounds = None      # first column, first row, last column, last row
+
+        self.order = {}         # entity -> add order
+        self.awake = {}         # active and pinned entities -> add order
+        self.added = 0
+        self._awake_list = None
+
+    def __contains__(self, entity):
+        return entity in self.entity_cells
+
+    def add(self, entity, pinned=False):
+        self.order[entity] = self.added
+        self.added += 1
+        if pinned:
+            # Updated whatever their flag says, as the flag is theirs to set
+            self.awake[entity] = self.order[entity]
+            self._awake_list = None
+            return
+
+        cell = self._cell(entity)
+        self.cells.setdefault(cell, {})[entity] = None
+        self.entity_cells[entity] = cell
+        if self._inside(cell):
+            self._wake(entity)
+        else:
+            self._sleep(entity)
+
+    def awake_entities(self):
+        ''' Active and pinned entities in the order they were added. A new
+        list whenever the set changes, so it is safe to iterate while
+        entities are added, removed, woken or put to sleep. '''
+        if self._awake_list is None:
+            self._awake_list = sorted(self.awake, key=self.awake.__getitem__)
+        return self._awake_list
+
+    def clear(self):
+        self.cells = {}
+        self.entity_cells = {}
+        self.bounds = None
+        self.order = {}
+        self.awake = {}
+        self._awake_list = None
+
+    def move(self, x, y):
+        ''' Place the zone's top left at (x, y). Returns the entities it
+        deactivated. '''
+        size = ActivityZone.CELL_SIZE
+        bounds = (int(x // size), int(y // size),
+                  int((x + self.width) // size),
+                  int((y + self.height) // size))
+        previous = self.bounds
+        if bounds == previous:
+            return []
+        self.bounds = bounds
+
+        left = []
+        if previous is None:
+            # Entities added before the zone was placed were all activated
+            for cell, members in self.cells.items():
+                if not self._inside(cell):
+                    for entity in members:
+                        self._sleep(entity)
+                        left.append(entity)
+            return left
+
+        for cell in self._cells(previous):
+            if not self._inside(cell):
+                for entity in self.cells.get(cell, ()):
+                    if entity.active:
+                        left.append(entity)
+                    self._sleep(entity)
+        for cell in self._cells(bounds):
+            if not self._inside(cell, previous):
+                for entity in self.cells.get(cell, ()):
+                    self._wake(entity)
+        return left
+
+    def remove(self, entity):
+        self.order.pop(entity, None)
+        if self.awake.pop(entity, None) is not None:
+            self._awake_list = None
+
+        cell = self.entity_cells.pop(entity, None)
+        if cell is not None:
+            members = self.cells[cell]
+            del members[entity]
+            if not members:
+                del self.cells[cell]
+
+    def update(self, entity):
+        ''' Re-bucket entity after it moves. Returns False if it left the
+        zone, and is now inactive. '''
+        previous = self.entity_cells.get(entity)
+        if previous is None:
+            return True
+
+        cell = self._cell(entity)
+        if cell != previous:
+            del self.cells[previous][entity]
+            if not self.cells[previous]:
+                del self.cells[previous]
+            self.cells.setdefault(cell, {})[entity] = None
+            self.entity_cells[entity] = cell
+            if not self._inside(cell):
+                self._sleep(entity)
+                return False
+        return True
+
+    def _cell(self, entity):
+        size = ActivityZone.CELL_SIZE
+        return (int((entity.x + entity.width / 2) // size),
+                int((entity.y + entity.height / 2) // size))
+
+    def _cells(self, bounds):
+        first_column, first_row, last_column, last_row = bounds
+        return [(column, row)
+                for column in range(first_column, last_column + 1)
+                for row in range(first_row, last_row + 1)]
+
+    def _inside(self, cell, bounds=None):
+        if bounds is None:
+            bounds = self.bounds
+        if bounds is None:
+            return True
+        first_column, first_row, last_column, last_row = bounds
+        return first_column <= cell[0] <= last_column and \
+            first_row <= cell[1] <= last_row
+
+    def _sleep(self, entity):
+        entity.active = False
+        if self.awake.pop(entity, None) is not None:
+            self._awake_list = None
+
+    def _wake(self, entity):
+        entity.active = True
+        if entity not in self.awake:
+            self.awake[entity] = self.order[entity]
+            self._awake_list = None
+
+
 class Camera(peachy.utils.Camera):
     # TODO add shake
     CENTER_LOCKED = 'CENTER'
@@ -178,6 +390,93 @@ class CheckpointData(object):
         return checkpoint
 
 
+class ChunkedLayer(object):
+    ''' A static tile layer pre-rendered into square offscreen chunks. Only
+    the chunks that overlap the view are drawn each frame, and chunks
+    without tiles have no surface at all. '''
+
+    CHUNK_SIZE = 256
+
+    def __init__(self, stage_data, layer):
+        self.stage_data = stage_data
+        self.layer = layer
+        self.name = layer.name
+
+        size = ChunkedLayer.CHUNK_SIZE
+        self.columns = int(math.ceil(stage_data.width / size))
+        self.rows = int(math.ceil(stage_data.height / size))
+
+        self.parts = {}    # (column, row) -> layer part, see layer_chunks
+        for chunk, part in stage.layer_chunks(stage_data, layer,
+                                              size).items():
+            if chunk[0] < self.columns and chunk[1] < self.rows:
+                self.parts[chunk] = part
+        self.chunks = {}   # (column, row) -> Surface, None where no tiles
+        self.dirty = set()
+
+        self._bake_all()
+
+    def free(self):
+        self.parts = {}
+        self.chunks = {}
+        self.dirty = set()
+
+    def mark_dirty(self, x, y, width, height):
+        ''' Queue every chunk touching the rect (in pixels) to be re-rendered
+        before it is next drawn '''
+        size = ChunkedLayer.CHUNK_SIZE
+        for column in range(max(0, int(x // size)),
+                            min(self.columns, int((x + width) // size) + 1)):
+            for row in range(max(0, int(y // size)),
+                             min(self.rows, int((y + height) // size) + 1)):
+                if (column, row) in self.parts:
+                    self.dirty.add((column, row))
+
+    def render(self, view_x, view_y, view_width, view_height):
+        size = ChunkedLayer.CHUNK_SIZE
+        first_column = max(0, int(view_x // size))
+        last_column = min(self.columns - 1, int((view_x + view_width) // size))
+        first_row = max(0, int(view_y // size))
+        last_row = min(self.rows - 1, int((view_y + view_height) // size))
+
+        visible = [(column, row)
+                   for column in range(first_column, last_column + 1)
+                   for row in range(first_row, last_row + 1)]
+
+        for chunk in visible:
+            if chunk in self.dirty:
+                self._bake(*chunk)
+
+        for column, row in visible:
+            chunk = self.chunks.get((column, row))
+            if chunk is not None:
+                peachy.graphics.draw(chunk, column * size, row * size)
+
+    def _bake(self, column, row):
+        ''' Draw the tiles reaching into the chunk, leaving the caller's
+        context and translation as they were '''
+        size = ChunkedLayer.CHUNK_SIZE
+        chunk = self.chunks.get((column, row))
+        if chunk is None:
+            chunk = peachy.graphics.Surface((size, size), pygame.SRCALPHA)
+            self.chunks[(column, row)] = chunk
+        else:
+            chunk.fill((0, 0, 0, 0))
+
+        context, translate_x, translate_y = graphics_target()
+        peachy.graphics.set_context(chunk)
+        peachy.graphics.translate(column * size, row * size)
+        stage.render_layer(self.stage_data, self.parts[(column, row)])
+        peachy.graphics.set_context(context)
+        peachy.graphics.translate(translate_x, translate_y)
+
+        self.dirty.discard((column, row))
+
+    def _bake_all(self):
+        for column, row in self.parts:
+            self._bake(column, row)
+
+
 class Graphic(peachy.Entity):
     ''' Display an image for a duration, then deletes it '''
     def __init__(self, x, y, image, duration):
@@ -387,6 +686,86 @@ class PriorityQueue(object):
         return heapq.heappop(self.elements)[1]
 
 
+class RenderQueue(object):
+    ''' While entered, peachy.graphics.draw calls are queued instead of drawn.
+    Queued images are culled against the context in one pass and blitted
+    with a single Surface.blits call. Any other drawing or context call
+    flushes the queue first, so everything still lands in call order. '''
+
+    FLUSHING = ('draw_arc', 'draw_circle', 'draw_line', 'draw_polygon',
+                'draw_rect', 'draw_rounded_rect', 'draw_text', 'pop_context',
+                'push_context', 'reset_context', 'set_context', 'translate')
+
+    def __init__(self):
+        self.pending = []
+        self.flipped = weakref.WeakKeyDictionary()  # image -> {flags: image}
+        self.flip_hits = 0  # flipped copies reused since last entered
+        self._originals = {}
+
+    def __enter__(self):
+        self.flip_hits = 0
+        replacements = {'draw': self.draw}
+        for name in RenderQueue.FLUSHING:
+            replacements[name] = self._flushing(getattr(peachy.graphics, name))
+        self._originals = patch_graphics(replacements)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A frame that raised is dropped rather than half drawn
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            del self.pending[:]
+            restore_graphics(self._originals)
+            self._originals = {}
+
+    def draw(self, image, x, y, args=0):
+        self.pending.append((image, x, y, args))
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        context, translate_x, translate_y = graphics_target()
+        context_width, context_height = context.get_size()
+        flip_flags = peachy.graphics.FLIP_X | peachy.graphics.FLIP_Y
+
+        blits = []
+        for image, x, y, args in self.pending:
+            x -= translate_x
+            y -= translate_y
+
+            if x < context_width and y < context_height and \
+               x + image.get_width() > 0 and y + image.get_height() > 0:
+                if args & flip_flags:
+                    image = self._flip(image, args & flip_flags)
+                blits.append((image, (x, y)))
+
+        context.blits(blits, False)
+        del self.pending[:]
+
+    def _flip(self, image, flags):
+        flips = self.flipped.get(image)
+        if flips is None:
+            flips = self.flipped[image] = {}
+        flipped = flips.get(flags)
+        if flipped is None:
+            flipped = pygame.transform.flip(
+                image, bool(flags & peachy.graphics.FLIP_X),
+                bool(flags & peachy.graphics.FLIP_Y))
+            flips[flags] = flipped
+        else:
+            self.flip_hits += 1
+        return flipped
+
+    def _flushing(self, function):
+        def flush_first(*args, **kwargs):
+            self.flush()
+            return function(*args, **kwargs)
+        return flush_first
+
+
 class Rect(peachy.Entity):
     def __init__(self, x, y, width=None, height=None):
         if width is None or height is None:
@@ -397,3 +776,94 @@ class Rect(peachy.Entity):
         peachy.Entity.__init__(self, x, y)
         self.width = width
         self.height = height
+
+
+class StaticCollisionIndex(object):
+    ''' Bounding volume tree over entities that never move once a stage has
+    loaded. Built in one pass, removals only prune leaves. '''
+
+    LEAF_SIZE = 8
+
+    def __init__(self):
+        self.root = None
+        self.leaves = {}  # entity -> leaf node holding it
+        self.order = {}   # entity -> build order, keeps query results stable
+
+    def __contains__(self, entity):
+        return entity in self.leaves
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def build(self, entities):
+        self.clear()
+        entities = list(entities)
+        for i, entity in enumerate(entities):
+            self.order[entity] = i
+        if entities:
+            self.root = self._build_node(entities)
+
+    def clear(self):
+        self.root = None
+        self.leaves = {}
+        self.order = {}
+
+    def query(self, x, y, width, height):
+        hits = []
+        if self.root is None:
+            return hits
+
+        right = x + width
+        bottom = y + height
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.bottom <= y or node.top >= bottom or \
+               node.right <= x or node.left >= right:
+                continue
+
+            if node.children is not None:
+                stack.extend(node.children)
+            else:
+                for e in node.entities:
+                    if not (e.y + e.height <= y or e.y >= bottom or
+                            e.x + e.width <= x or e.x >= right):
+                        hits.append(e)
+
+        hits.sort(key=self.order.__getitem__)
+        return hits
+
+    def remove(self, entity):
+        leaf = self.leaves.pop(entity, None)
+        if leaf is not None:
+            leaf.entities.remove(entity)
+            del self.order[entity]
+
+    def _build_node(self, entities):
+        node = StaticCollisionIndex._Node(entities)
+
+        if len(entities) <= StaticCollisionIndex.LEAF_SIZE:
+            node.entities = entities
+            for entity in entities:
+                self.leaves[entity] = node
+        else:
+            # Split at the median along the longest axis
+            if node.right - node.left >= node.bottom - node.top:
+                entities.sort(key=lambda e: e.x + e.width / 2)
+            else:
+                entities.sort(key=lambda e: e.y + e.height / 2)
+            half = len(entities) // 2
+            node.children = (self._build_node(entities[:half]),
+                             self._build_node(entities[half:]))
+        return node
+
+    class _Node(object):
+        def __init__(self, entities):
+            self.left = min(e.x for e in entities)
+            self.top = min(e.y for e in entities)
+            self.right = max(e.x + e.width for e in entities)
+            self.bottom = max(e.y + e.height for e in entities)
+
+            self.children = None
+            self.entities = None
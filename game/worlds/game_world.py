@@ -1,10 +1,13 @@
+import random
+import time
+
 import peachy
 from peachy import PC
 from peachy.utils import Key
 
-from game import config, rooms
-from game.entities import Player
-from game.utility import save, load
+from game import assets, config, playback, profiler, rooms, text
+from game.entities import Player, drops
+from game.utility import save, load, wrap_text
 
 DECISION_STATE = 'decision'
 GAME_OVER_STATE = 'game over'
@@ -23,7 +26,7 @@ def DEBUG_render_options(self):
             peachy.graphics.set_color(255, 255, 255)
         option = self.options[i]
         y = 8 * (i + 4)
-        peachy.graphics.draw_text(option, 12, y)
+        text.draw(option, 12, y)
 
 
 class GameWorld(peachy.World):
@@ -44,6 +47,10 @@ class GameWorld(peachy.World):
         self.state = self.states[PLAY_STATE]
         self.stage = rooms.OverYonderRoom()
 
+        self.recording = None  # playback.Recording being captured
+        self.replay = None     # playback.ScriptedKeys, while replaying
+        self.replay_ticks = 0
+
         self.subcontext = peachy.graphics.Surface((config.WINDOW_HEIGHT,
                                                    config.WINDOW_WIDTH))
         self.subcontext_rect = self.subcontext.get_rect()
@@ -77,6 +84,63 @@ class GameWorld(peachy.World):
             Player.Item.ID_PLANET_REPTILIA
         ]
 
+    def restart(self, recording):
+        ''' Load recording's stage afresh, as it was when recorded: drops
+        seeded, the room's flags set, and a new player with its items,
+        health and ammo at its start '''
+        drops.seed(recording.seed)
+        self.state = self.states[PLAY_STATE]
+        self.stage.flags = list(recording.flags)
+
+        player = Player(0, 0)
+        player.items = list(recording.items)
+        if recording.max_health is not None:
+            player.max_health = recording.max_health
+        if recording.health is not None:
+            player.health = recording.health
+        if recording.ammo is not None:
+            player.ammo = recording.ammo
+        self.stage.player = player
+        self.stage._load_stage(recording.stage, recording.x is None)
+
+        if recording.x is not None:
+            player.x = recording.x
+            player.y = recording.y
+            self.stage.camera.snap(player.x, player.y, True)
+
+    def start_recording(self):
+        ''' Restart the stage where the player stands and log input from
+        the next tick on '''
+        player = self.stage.player
+        recording = playback.Recording(
+            self.stage.stage_path, random.getrandbits(32), player.x,
+            player.y, player.items, health=player.health,
+            max_health=player.max_health, ammo=player.ammo,
+            flags=self.stage.flags)
+        self.restart(recording)
+        self.recording = recording
+
+    def stop_recording(self, file_name):
+        self.recording.save(file_name)
+        print('[LOG] recorded %d ticks to %s' %
+              (self.recording.ticks, file_name))
+        self.recording = None
+
+    def start_replay(self, file_name):
+        recording = playback.Recording.load(file_name)
+        self.restart(recording)
+
+        # Keys the recording did not log still come from the keyboard
+        self.replay = playback.ScriptedKeys(recording.script(),
+                                            recording.keys)
+        self.replay_ticks = recording.ticks
+        self.replay.install()
+
+    def stop_replay(self):
+        self.replay.uninstall()
+        self.replay = None
+        print('[LOG] replay finished')
+
     def new_game(self):
         self.stage._load_stage("stage/oberon_landing_site.tmx")
         player = self.stage.player
@@ -95,7 +159,7 @@ class GameWorld(peachy.World):
         data.append(self.stage.stage.path)
         data.append(self.stage.player.ammo)
         data.append(self.stage.player.items)
-        data.append(self.stage.event_flags)
+        data.append(self.stage.flags)
 
         save(data, file_name)
 
@@ -127,13 +191,31 @@ class GameWorld(peachy.World):
         # Draw stage
         self.state.render()
 
+        if profiler.enabled:
+            peachy.graphics.translate(0, 0)
+            profiler.render(8, 28)
+            profiler.end_frame()
+
     def update(self):
         if PC.debug:
             if peachy.utils.Key.pressed('q'):
                 print(self.stage.player.items)
 
+            # F2 shows per-system frame timings, F3 records them to a CSV
+            if peachy.utils.Key.pressed('F2'):
+                profiler.toggle()
+            elif peachy.utils.Key.pressed('F3'):
+                if profiler.recording:
+                    profiler.stop_recording()
+                else:
+                    profiler.start_recording()
+
         # Update entities
         if peachy.utils.Key.pressed('escape'):
+            if profiler.recording:
+                profiler.stop_recording()
+            if self.recording is not None:
+                self.stop_recording('debug.oyr')
             PC.quit()
         elif PC.debug and peachy.utils.Key.pressed('F1'):
             self.load_game('debug.sav')
@@ -141,8 +223,34 @@ class GameWorld(peachy.World):
         elif PC.debug and peachy.utils.Key.pressed('1'):
             self.save_game('debug.sav')
             print('Game Saved')
+        elif PC.debug and peachy.utils.Key.pressed('F4'):
+            # Record input, restarting the stage so it can be replayed
+            if self.recording is not None:
+                self.stop_recording('debug.oyr')
+            elif self.replay is None:
+                self.start_recording()
+        elif PC.debug and peachy.utils.Key.pressed('F5'):
+            if self.replay is not None:
+                self.stop_replay()
+            elif self.recording is None:
+                self.start_replay('debug.oyr')
         else:
-            self.state.update()
+            # Input is captured or replayed on exactly the ticks the state
+            # updates on
+            if self.recording is not None:
+                self.recording.capture()
+            elif self.replay is not None:
+                if self.replay.tick < self.replay_ticks:
+                    self.replay.step()
+                else:
+                    self.stop_replay()
+
+            if profiler.enabled:
+                start = time.perf_counter()
+                self.state.update()
+                profiler.add('update', time.perf_counter() - start)
+            else:
+                self.state.update()
 
 
 class AbsMenuState(peachy.State):
@@ -190,7 +298,7 @@ class DecisionState(AbsMenuState):
 
     def render(self):
         peachy.graphics.set_color(255, 255, 255)
-        peachy.graphics.draw_text(self.message, 8, 8)
+        text.draw(self.message, 8, 8)
 
         DEBUG_render_options(self)
 
@@ -202,7 +310,7 @@ class GameOverState(peachy.State):
 
     def render(self):
         peachy.graphics.set_color(255, 255, 255)
-        peachy.graphics.draw_text('GAME OVER', 8, 8)
+        text.draw('GAME OVER', 8, 8)
 
     def update(self):
         if Key.pressed('ANY'):
@@ -215,12 +323,14 @@ class MessageState(peachy.State):
         super().__init__(MESSAGE_STATE, world)
         self.previous_state = None
         self.message = ''
+        self.lines = []
 
         self.width = PC.width - 64
         self.height = PC.height - 64
 
     def enter(self, previous_state, *args):
         self.message = args[0]
+        self.lines = wrap_text(self.message, self.width)
         self.previous_state = previous_state
 
     def update(self):
@@ -233,11 +343,12 @@ class MessageState(peachy.State):
         peachy.graphics.set_color(0, 0, 0)
         peachy.graphics.draw_rect(32, 32, self.width, self.height)
         peachy.graphics.set_color(255, 255, 255)
-        peachy.graphics.draw_text(self.message, 32, 32)
 
-        # split words
-        # check width of each word (use monospace font)
-        # if width is greater than line width, new line
+        y = 32
+        line_height = peachy.graphics.font().get_sized_height()
+        for line in self.lines:
+            text.draw(line, 32, y)
+            y += line_height
 
 
 class PauseState(peachy.State):
@@ -249,7 +360,7 @@ class PauseState(peachy.State):
         self.world.stage.render()
         peachy.graphics.translate(0, 0)
         peachy.graphics.set_color(0, 0, 0)
-        peachy.graphics.draw_text('PAUSED', 8, 8)
+        text.draw('PAUSED', 8, 8)
 
     def enter(self, previous_state, *args):
         self.world.stage.pause()
@@ -275,10 +386,13 @@ class PlayState(peachy.State):
         peachy.graphics.translate(0, 0)
         if PC.debug:
             peachy.graphics.set_color(255, 255, 255)
-            peachy.graphics.draw_text(
+            text.draw(
                 'HP: %d / %d' %
                 (self.world.stage.player.health,
                  self.world.stage.player.max_health), 8, 8)
+            text.draw(
+                'DRAWN: %d CULLED: %d FLIPS CACHED: %d' %
+                self.world.stage.render_counts, 8, 16)
         # else:
         #     GUI.draw_HUD()
 
@@ -298,7 +412,7 @@ class RoomTransitionState(peachy.State):
         self.graphic = None
         self.new_stage = ''
 
-        self.graphic = peachy.graphics.SpriteMap(peachy.fs.get_image('VFX_TRANSITIONS'), 8, 8)
+        self.graphic = peachy.graphics.SpriteMap(assets.get_image('VFX_TRANSITIONS'), 8, 8)
         self.graphic.add('ROOM_TRANSITION_START', [0, 1, 2, 3, 4, 5, 6], 3, False, self.process)
         self.graphic.add('ROOM_TRANSITION_END', [6, 5, 4, 3, 2, 1, 0], 3, False, self._exit)
 
@@ -353,7 +467,7 @@ class ShipState(AbsMenuState):
 
     def render(self):
         peachy.graphics.set_color(255, 255, 255)
-        peachy.graphics.draw_text('WORLDS', 8, 16)
+        text.draw('WORLDS', 8, 16)
 
         DEBUG_render_options(self)
 
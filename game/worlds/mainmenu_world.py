@@ -1,6 +1,7 @@
 import peachy
 from peachy import PC
 
+from game import text
 from game.config import KEY, SAVE_FILE
 
 
@@ -31,7 +32,7 @@ class MainMenuWorld(peachy.World):
 
     def render(self):
         peachy.graphics.set_color(255, 255, 255)
-        peachy.graphics.draw_text('OVER YONDER', 8, 8)
+        text.draw('OVER YONDER', 8, 8)
 
         for i in range(len(self.options)):
             if i == self.current_selection:
@@ -40,7 +41,7 @@ class MainMenuWorld(peachy.World):
                 peachy.graphics.set_color(255, 255, 255)
             option = self.options[i]
             y = 8 * (i + 4)
-            peachy.graphics.draw_text(option, 12, y)
+            text.draw(option, 12, y)
 
     def update(self):
         if peachy.utils.Key.pressed(KEY['UP']):
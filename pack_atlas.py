@@ -0,0 +1,27 @@
+# Packs the entity, item and HUD images named in assets/manifest.json into
+# atlas sheets, read by game.assets in place of the separate files. Images in
+# a manifest group (planet backgrounds) are left out, they come and go with
+# their planet.
+#
+# Usage: python pack_atlas.py
+
+import os
+
+import pygame
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+pygame.display.init()
+pygame.display.set_mode((1, 1))
+
+from game import assets
+
+
+def main():
+    assets.load_manifest()
+    for path in assets.pack_atlas():
+        print('packed ' + path)
+    print('wrote ' + assets.ATLAS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# Runs stages headless, for benchmarks and regression checks: no window, no
+# real-time clock and no keyboard. Input comes from a script or a recording
+# (see game/playback.py), and each stage is updated and rendered offscreen
+# for a fixed number of ticks as fast as it will go, or at the game's tick
+# rate with --real-time. Reports ticks per second and the profiler's
+# per-section timings (see game/profiler.py).
+#
+# Usage: python simulate.py [STAGE ...] [-t TICKS] [-i SCRIPT] [-s SEED]
+#                           [-r RECORDING] [--real-time]
+#                           [-o CSV_DIRECTORY] [--min-tps TPS]
+#
+# STAGE is a .tmx file in assets/stage, all of them by default. A recording
+# replays its own stage, seed and input, for as many ticks as it holds
+# unless -t is given. With --min-tps, exits with status 1 if any stage runs
+# slower than that.
+
+import glob
+import os
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import peachy
+from game import OverYonderEngine, assets, profiler
+from game.playback import Recording, ScriptedKeys, load_script
+from game.worlds import GameWorld
+
+STAGE_DIRECTORY = 'assets/stage'
+EXCLUDED_STAGES = ('template.tmx',)
+
+TICK_RATE = 45
+
+
+def start():
+    # OverYonderEngine.preload, without the menu or a stage from argv
+    engine = OverYonderEngine(False)
+    peachy.fs.load_font('MAIN', 'assets/visitor1.ttf', 10)
+    peachy.graphics.set_font(peachy.fs.get_font('MAIN'))
+    assets.load_manifest()
+
+    world = GameWorld()
+    engine.add_world(world)
+    engine.change_world('GAME')
+    return world
+
+
+def simulate(world, recording, ticks, script, real_time=False):
+    ''' Profiler frames recorded over ticks of recording's stage, and the
+    seconds they took '''
+    world.restart(recording)
+
+    keys = ScriptedKeys(script)
+    keys.install()
+
+    # Starts the first tick's clock
+    profiler.start_recording()
+    profiler.end_frame()
+    begin = time.perf_counter()
+    try:
+        for tick in range(ticks):
+            if real_time:
+                # Time spent waiting shows up as 'other'
+                wait = begin + tick / TICK_RATE - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+
+            keys.step()
+            world.update()
+            world.state.render()
+            profiler.end_frame()
+    finally:
+        keys.uninstall()
+
+    return profiler.recorded(), time.perf_counter() - begin
+
+
+def report(frames):
+    if not frames:
+        print('  no frames recorded')
+        return
+
+    sections = sorted(set().union(*frames) - {'total'})
+    print('  %-22s %7s %7s %7s %7s %7s' %
+          ('ms', 'mean', 'p50', 'p95', 'p99', 'max'))
+    for section in ['total'] + sections:
+        samples = sorted(frame.get(section, 0.0) for frame in frames)
+        print('  %-22s %7.3f %7.3f %7.3f %7.3f %7.3f' %
+              ((section[:22], sum(samples) / len(samples)) +
+               tuple(profiler.percentile(samples, p) for p in (50, 95, 99)) +
+               (samples[-1],)))
+
+
+def stage_path(name):
+    # Rooms load stages by their path under assets/
+    prefix = STAGE_DIRECTORY + '/'
+    if name.startswith(prefix):
+        name = name[len(prefix):]
+    return 'stage/' + name
+
+
+def main(argv):
+    ticks = None
+    script = ()
+    seed = 0
+    replay = None
+    real_time = False
+    csv_directory = None
+    min_tps = None
+
+    stages = []
+    args = iter(argv)
+    for arg in args:
+        if arg == '-t':
+            ticks = int(next(args))
+        elif arg == '-i':
+            script = load_script(next(args))
+        elif arg == '-s':
+            seed = int(next(args))
+        elif arg == '-r':
+            replay = Recording.load(next(args))
+        elif arg == '--real-time':
+            real_time = True
+        elif arg == '-o':
+            csv_directory = next(args)
+            os.makedirs(csv_directory, exist_ok=True)
+        elif arg == '--min-tps':
+            min_tps = float(next(args))
+        else:
+            stages.append(arg)
+
+    if replay is not None:
+        runs = [(replay, replay.script())]
+        if ticks is None:
+            ticks = replay.ticks
+    else:
+        if not stages:
+            paths = sorted(glob.glob(os.path.join(STAGE_DIRECTORY, '*.tmx')))
+            stages = [path for path in paths
+                      if os.path.basename(path) not in EXCLUDED_STAGES]
+        runs = [(Recording(stage_path(name), seed), script)
+                for name in stages]
+        if ticks is None:
+            ticks = 2000
+
+    # An empty recording comes to no ticks too
+    if ticks < 1:
+        print('[ERROR] nothing to simulate: %d ticks' % ticks)
+        return 1
+
+    world = start()
+    too_slow = []
+    for recording, run_script in runs:
+        path = recording.stage
+        frames, elapsed = simulate(world, recording, ticks, run_script,
+                                   real_time)
+
+        tps = ticks / elapsed
+        print('%s: %d ticks in %.2f s, %.1f ticks/s (%.1fx real time)' %
+              (path, ticks, elapsed, tps, tps / TICK_RATE))
+        report(frames)
+
+        if csv_directory is not None:
+            profiler.stop_recording(os.path.join(
+                csv_directory, os.path.splitext(os.path.basename(path))[0] +
+                '.csv'))
+        if min_tps is not None and tps < min_tps:
+            too_slow.append(path)
+
+    world.stage.close()
+    if too_slow:
+        print('[ERROR] below %.1f ticks/s: %s' %
+              (min_tps, ', '.join(too_slow)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,7 @@
 import peachy
 
+from game import assets
+
 
 class GUI(object):
     # TODO move to new module
@@ -9,8 +11,8 @@ class GUI(object):
 
     @staticmethod
     def init():
-        GUI.HEALTH_POINT = peachy.fs.get_image('HUD_HEALTH_FULL')
-        GUI.HEALTH_EMPTY = peachy.fs.get_image('HUD_HEALTH_EMPTY')
+        GUI.HEALTH_POINT = assets.get_image('HUD_HEALTH_FULL')
+        GUI.HEALTH_EMPTY = assets.get_image('HUD_HEALTH_EMPTY')
 
     @staticmethod
     def draw_HUD():